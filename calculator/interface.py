@@ -8,8 +8,13 @@ import requests
 import datetime
 from lxml import etree
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from django.db import transaction
-from django.db.models import Avg, Q, F, Sum, Count
+from django.db.models import Avg, Q, F, Sum, Count, Max, DecimalField
 
 from explorer_s_common import debug, consts, cache, raw_sql, inner_server
 from explorer_s_common.utils import format_return, Validator, format_power, format_price, format_fil, str_2_power
@@ -20,8 +25,9 @@ from explorer_s_common.third.filscan_sdk import FilscanBase
 from explorer_s_common.third.bbhe_sdk import BbheBase
 
 from explorer_s_activity.consts import ERROR_DICT
+from explorer_s_activity.utils import TokenBucket, fetch_concurrently, ColumnarRows, RowFormatter
 from calculator.models import TotalPower, Tipset, TipsetBlock, SearchLog, TotalPowerDay, \
-    TempTipsetBlock, GasFeeDay
+    TempTipsetBlock, GasFeeDay, TipsetRewardLedger, TipsetRewardCheckpoint
 
 
 class CalculatorBase(object):
@@ -82,6 +88,7 @@ class CalculatorBase(object):
         obj.keep_gas = result['data']['dayPostMaintainGasFee32'] + result['data']['dayPostMaintainGasFee64']
         obj.packing_power = _d(result['data']['dayPackingNum']) * _d(1024**4)
         obj.save()
+        GasStatBase().get_avg_gas_stat(must_update_cache=True)
         return format_return(0)
 
     def get_total_power_day_records(self):
@@ -256,53 +263,46 @@ class CalculatorBase(object):
         # print('filscan 数据-->' + format_power(increase_power))
         return increase_power
 
-    def get_day_reward_per_t(self, current_day, increase_power_per_day=10, current_net_power=569, avg_tipset_blocks=5):
+    def get_day_block_reward(self, day, avg_tipset_blocks=5, current_net_power=569):
         '''
-        获取当日单T收益
+        获取主网第day天的区块奖励(简单奖励 + 基线奖励)
+        简单奖励是等比数列、基线奖励是等差数列，直接用求和公式计算，结果按(天, 平均区块数, 奖励档位)缓存在进程内
         '''
-        _opt = {
-            'VestedReleasePerYear': 50000000 + 16666666 + 50000000 + 5373603,
-            'totalPowerP_Grow_perDayLimit': increase_power_per_day,
-            'totalPowerBaseLineEB': 2.5,
-            'MainNetFromBlock': 148888,
-            'MainNetFromPower': current_net_power,
-            'avgWinCount': avg_tipset_blocks
-        }
-        opt = {
-            'totalPowerGBBaseLine': _opt['totalPowerBaseLineEB'] * 1024 * 1024 * 1024,
-            'avgWinCount': _opt['avgWinCount'],
-        }
-
-        def getSimpleBlockReward(blockNum):
-            '''
-            全网总算力大于2.5EiB，则直接返回770000000，否则返回330000000
-            '''
-            T = blockNum / 2880
-            tempReward = 330000000
-
-            if current_net_power > (_opt['totalPowerBaseLineEB'] * 1024.0):
-                tempReward = 770000000
+        # 全网总算力大于2.5EiB，则简单奖励按770000000计算，否则按330000000
+        simple_minted = 770000000 if current_net_power > (2.5 * 1024.0) else 330000000
+        key = (day, avg_tipset_blocks, simple_minted)
+        if key in _day_block_reward_table:
+            return _day_block_reward_table[key]
 
-            return tempReward * math.exp(-1.09897764548444e-7 * ((T * 2880 + 1) - 1)) * (1.09897764548444e-7) / 5
+        rate = 1.09897764548444e-7
+        count = 2880
+        start_block = 148888 + 2880 * (day - 1)
+        simple_reward = simple_minted * rate / 5 * math.exp(-rate * start_block) * math.expm1(-rate * count) / math.expm1(-rate)
+        # 0.1586 * T - 0.041 按2.5EiB基线折算，T = 高度 / 2880
+        baseline_reward = (0.1586 / 2880 * (start_block * count + count * (count - 1) / 2) - 0.041 * count) / 2.5
 
-        def getBaseLineBlockReward(blockNum):
-            T = blockNum / 2880
-            baselineBlockReword = 0.1586 * T - 0.041
-            return baselineBlockReword / (opt['totalPowerGBBaseLine'] / 1024 / 1024 / 1024)
+        _day_block_reward_table[key] = decimal.Decimal(simple_reward + baseline_reward) * avg_tipset_blocks
+        return _day_block_reward_table[key]
 
-        @cache_required(cache_key='day_block_reward_%s', expire=7 * 24 * 60 * 60, cache_key_type=1)
-        def getDayBlockReward(day):
-            _dayBlockReward = 0
-            for i in range(_opt['MainNetFromBlock'] + 2880 * (day - 1), _opt['MainNetFromBlock'] + 2880 * day):
-                _dayBlockReward += decimal.Decimal(getSimpleBlockReward(i) + getBaseLineBlockReward(i)) * _opt['avgWinCount']
-
-            return _dayBlockReward
+    def load_day_block_rewards(self, start_day, end_day, avg_tipset_blocks=5, current_net_power=569):
+        '''
+        批量计算[start_day, end_day]的每日区块奖励
+        '''
+        return [
+            self.get_day_block_reward(day=day, avg_tipset_blocks=avg_tipset_blocks, current_net_power=current_net_power)
+            for day in range(start_day, end_day + 1)
+        ]
 
-        _dayBlockReward = getDayBlockReward(current_day)
+    def get_day_reward_per_t(self, current_day, increase_power_per_day=10, current_net_power=569, avg_tipset_blocks=5):
+        '''
+        获取当日单T收益
+        '''
+        _dayBlockReward = self.get_day_block_reward(
+            day=current_day, avg_tipset_blocks=avg_tipset_blocks, current_net_power=current_net_power
+        )
 
         # 当前主网算力和算力增速统一按PiB计算，然后换算成TiB
-        # _dayMainNetPower = (_opt['MainNetFromPower'] + _opt['totalPowerP_Grow_perDayLimit']) * 1024
-        _dayMainNetPower = (_opt['MainNetFromPower'] + _opt['totalPowerP_Grow_perDayLimit'] * current_day) * 1024
+        _dayMainNetPower = (current_net_power + increase_power_per_day * current_day) * 1024
         return decimal.Decimal(_dayBlockReward / _dayMainNetPower)
 
     def get_create_gas(self, day, data, package_days, create_cost_gas_per_t):
@@ -389,6 +389,46 @@ class CalculatorBase(object):
             total += per['today_release_principal']
         return total
 
+    def accumulate_lookup(self, data, release_days=180, package_days=540):
+        '''
+        单次遍历计算释放与累计列
+        data按day升序且连续，结果与逐日调用get_today_release、get_total_*等方法一致
+        '''
+        # 当日释放只取(day - release_days, day)区间内的线性释放，用滑动窗口维护
+        line_release_window = 0
+        pledge_dict = {}
+        total_pledge = 0
+        total_reward = 0
+        total_release = 0
+        total_release_principal = 0
+        for index, per in enumerate(data):
+            day = per['day']
+            pledge_dict[day] = per.get('today_pledge', 0)
+
+            #======== 当日释放奖励
+            if day > 1:
+                prev = data[index - 1]
+                line_release_window += prev['today_reward'] * decimal.Decimal(0.75) / decimal.Decimal(release_days)
+                if index - release_days >= 0:
+                    out = data[index - release_days]
+                    line_release_window -= out['today_reward'] * decimal.Decimal(0.75) / decimal.Decimal(release_days)
+                per['today_release'] = per['today_reward'] * decimal.Decimal(0.25) + line_release_window
+            #======== 当日释放本金，package_days天之后开始释放本金
+            if day > package_days:
+                per['today_release_principal'] = pledge_dict.get(day - package_days, 0)
+
+            total_pledge += per.get('today_pledge', 0)
+            total_reward += per['today_reward']
+            total_release += per['today_release']
+            total_release_principal += per.get('today_release_principal', 0)
+
+            per['total_pledge'] = total_pledge
+            per['total_reward'] = total_reward
+            per['total_release'] = total_release
+            per['total_release_principal'] = total_release_principal
+            per['total_already_release'] = total_release + total_release_principal
+        return data
+
     def get_day_net_power_p(self, current_date, increase_power_per_day):
         '''
         获取当天的算力
@@ -404,9 +444,24 @@ class CalculatorBase(object):
         now_net_power = decimal.Decimal(format_power(objs[0].power, 'PiB').strip('PiB'))
         return now_net_power + decimal.Decimal((current_date - now_date).days * increase_power_per_day)
 
-    def generate_lookup(self, current_date, power_per_day=2, total_power=120, increase_power_per_day=10, init_power=0, luck_v='0.997', is_merge=True, direct_avg_reward_dict=None):
+    def get_lookup_context(self):
+        '''
+        生成对照表的公用数据，批量计算时多个场景共享
+        lookups按(幸运值, 算力增速, 偏移天数, 是否融合)缓存每日奖励和质押的对照
+        '''
+        gas_info = GasStatBase().get_gas_cost_info()
+        return {
+            'overview': self.get_fil_overview(),
+            'gas_info_32': gas_info['gas_info_32'],
+            'gas_info_64': gas_info['gas_info_64'],
+            'lookups': {}
+        }
+
+    def generate_lookup(self, current_date, power_per_day=2, total_power=120, increase_power_per_day=10, init_power=0, luck_v='0.997', is_merge=True, direct_avg_reward_dict=None, context=None, is_format=True):
         '''
         生成对照表
+        context: get_lookup_context的结果，不传则重新获取
+        is_format: 是否按LOOKUP_DETAIL_FORMATTER格式化，分块输出时由调用方格式化
         '''
         # today_reward_per_day = decimal.Decimal(0.2121)
         # today_pledge_per_day = decimal.Decimal(6.3104)
@@ -415,7 +470,8 @@ class CalculatorBase(object):
         change_date = datetime.datetime(2020, 12, 17)
         now = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         run_days = (current_date - start_date).days
-        overview = self.get_fil_overview()
+        context = context or self.get_lookup_context()
+        overview = context['overview']
         today_pledge_per_day = decimal.Decimal(overview.get('avg_pledge')) * 32
         avg_tipset_blocks = decimal.Decimal(overview.get('avg_tipset_blocks', 5))
         increase_power_per_day = decimal.Decimal(increase_power_per_day)
@@ -431,10 +487,10 @@ class CalculatorBase(object):
         # keep_cost_gas_per_t = gas_stat['submit_windowed_po_st'] / current_net_power_t
         # print('keep_cost_gas_per_t:', keep_cost_gas_per_t)
         # =============================================================
-        gas_info_32 = inner_server.get_gas_cost_stat({'sector_type': '0'}).get('data', {})
+        gas_info_32 = context['gas_info_32']
         create_cost_gas_per_t = _d(gas_info_32['create_gas'])
         keep_cost_gas_per_t = _d(gas_info_32['keep_gas'])
-        gas_info_64 = inner_server.get_gas_cost_stat({'sector_type': '1'}).get('data', {})
+        gas_info_64 = context['gas_info_64']
         create_cost_gas_per_t_64 = _d(gas_info_64['create_gas'])
         keep_cost_gas_per_t_64 = _d(gas_info_64['keep_gas'])
 
@@ -445,12 +501,16 @@ class CalculatorBase(object):
             cache_key = '%s_%.2f' % (luck_v, increase_power_per_day)
             print('cache_key-->', cache_key)
             _offset_days = (current_date - now).days
-            if is_merge:
-                avg_reward_lookups = LookupBase().get_lookups(cache_key, luck_v=luck_v, increase_power=increase_power_per_day, days=541 + _offset_days, must_update_cache=True if _offset_days > 0 else False)
-            else:
-                avg_reward_lookups = LookupBase().get_lookups(cache_key, luck_v=luck_v, increase_power=increase_power_per_day, days=541 + _offset_days, must_update_cache=True)
-            avg_reward_lookups_dict = dict([(x['date'].strftime('%Y-%m-%d'), x['avg_reward']) for x in avg_reward_lookups])
-            avg_pledge_lookups_dict = dict([(x['date'].strftime('%Y-%m-%d'), x['avg_pledge']) for x in avg_reward_lookups])
+            lookups_key = (cache_key, _offset_days, is_merge)
+            if lookups_key not in context['lookups']:
+                # 未来日期只需延长缓存的预测段
+                avg_reward_lookups = LookupBase().get_lookups(cache_key, luck_v=luck_v, increase_power=increase_power_per_day, days=541 + _offset_days)
+                dates = [x.strftime('%Y-%m-%d') for x in avg_reward_lookups.column('date')]
+                context['lookups'][lookups_key] = (
+                    dict(zip(dates, avg_reward_lookups.column('avg_reward'))),
+                    dict(zip(dates, avg_reward_lookups.column('avg_pledge')))
+                )
+            avg_reward_lookups_dict, avg_pledge_lookups_dict = context['lookups'][lookups_key]
 
         # 天数
         days = 541
@@ -485,6 +545,13 @@ class CalculatorBase(object):
         # 总释放本金
         total_release_principal = 0
 
+        # 老算法的每日区块奖励一次算好
+        if not direct_avg_reward_dict:
+            self.load_day_block_rewards(
+                start_day=run_days + 1, end_day=run_days + days - 1, avg_tipset_blocks=decimal.Decimal(5),
+                current_net_power=decimal.Decimal(569)
+            )
+
         data = []
         for i in range(1, days):
 
@@ -607,52 +674,12 @@ class CalculatorBase(object):
 
             # 查看器计算gas
             per['today_reward'] = per['today_reward_base']
-            #======== 当日释放奖励
-            if per['day'] > 1:
-                per['today_release'] = per['today_reward'] * decimal.Decimal(0.25) + self.get_today_release(day=per['day'], data=data, release_days=release_days)
-            #======== 当日释放本金，package_days天之后开始释放本金
-            if per['day'] > package_days:
-                per['today_release_principal'] = self.get_today_release_principal(day=per['day'], data=data, package_days=package_days)
-
-            #======== 累计质押
-            per['total_pledge'] = self.get_total_pledge(day=per['day'], data=data)
-
-            #======== 累计奖励
-            per['total_reward'] = self.get_total_reward(day=per['day'], data=data)
-
-            #======== 累计释放
-            per['total_release'] = self.get_total_release(day=per['day'], data=data)
-
-            #======== 累计释放本金
-            per['total_release_principal'] = self.get_total_release_principal(day=per['day'], data=data)
 
-            #======== 累计释放本金 + 奖励
-            per['total_already_release'] = per['total_release'] + per['total_release_principal']
-
-        for per in data:
-            per['date'] = per['date'].strftime('%Y-%m-%d')
-            per['reward_per_day'] = format_price(per['reward_per_day'], 8)
-            per['pledge_per_day'] = format_price(per['pledge_per_day'], 8)
-            per['today_new_power'] = format_price(per['today_new_power'], 2)
-            per['today_power'] = format_price(per['today_power'], 2)
-            per['today_pledge'] = format_price(per['today_pledge'], 8)
-            per['today_reward_base'] = format_price(per['today_reward_base'], 8)
-            per['today_reward'] = format_price(per['today_reward'], 8)
-            per['today_release'] = format_price(per['today_release'], 8)
-            per['today_release_principal'] = format_price(per['today_release_principal'], 8)
-            per['total_pledge'] = format_price(per['total_pledge'], 8)
-            per['total_reward'] = format_price(per['total_reward'], 8)
-            per['total_release'] = format_price(per['total_release'], 8)
-            per['total_release_principal'] = format_price(per['total_release_principal'], 8)
-            per['total_already_release'] = format_price(per['total_already_release'], 8)
-            per['create_cost_gas_per_t'] = format_price(per['create_cost_gas_per_t'], 8)
-            per['create_cost_gas_per_t_64'] = format_price(per['create_cost_gas_per_t_64'], 8)
-            per['keep_cost_gas_per_t'] = format_price(per['keep_cost_gas_per_t'], 8)
-            per['keep_cost_gas_per_t_64'] = format_price(per['keep_cost_gas_per_t_64'], 8)
-            per['create_gas'] = format_price(per['create_gas'], 8)
-            per['keep_gas'] = format_price(per['keep_gas'], 8)
-            per['total_keep_gas'] = format_price(per['total_keep_gas'], 8)
+        #======== 释放、累计质押、累计奖励等，单次遍历
+        self.accumulate_lookup(data=data, release_days=release_days, package_days=package_days)
 
+        if is_format:
+            LOOKUP_DETAIL_FORMATTER.apply(data)
         return data
 
     def add_search_log(self, user_id, start_date=None, speed=0, power=0, store_power=0, cost=0,
@@ -691,6 +718,7 @@ class CalculatorBase(object):
             obj.fee = per.get('avg_cost', 0)
             obj.total_fee = per.get('total_cost', 0)
             obj.save()
+        GasStatBase().get_avg_gas_stat(must_update_cache=True)
         return format_return(0)
 
 
@@ -701,36 +729,39 @@ class TipsetBase(object):
         if not result or not result.get('blocks'):
             return
 
-        tipset = Tipset.objects.filter(height=height)
-        if not tipset:
-            return
-        tipset = tipset[0]
         total_win_count = 0
         total_reward = 0
 
-        for per in result.get('blocks', []):
-            # 计算win_count
-            # t = float(per['reward_str_in_list'].replace('FIL', ''))
-            # p = float(per['reward'])
-            # win_count = math.floor(t / p) if p != 0 else 0
+        with transaction.atomic():
+            # 锁住高度再读旧的总奖励，并发写同一高度时差值不会重复累加
+            tipset = Tipset.objects.select_for_update().filter(height=height).first()
+            if not tipset:
+                return
+            old_total_reward = tipset.total_reward
+            for per in result.get('blocks', []):
+                # 计算win_count
+                # t = float(per['reward_str_in_list'].replace('FIL', ''))
+                # p = float(per['reward'])
+                # win_count = math.floor(t / p) if p != 0 else 0
 
-            block, created = TipsetBlock.objects.get_or_create(
-                block_hash=per['cid'], record_time=tipset.record_time
-            )
-            block.tipset = tipset
-            block.miner_address = per['miner']
-            block.msg_count = per['messageCount']
-            block.win_count = per['winCount']
-            block.reward = decimal.Decimal(per['reward']) + decimal.Decimal(per['penalty'])
-            block.height = height
-            block.save()
-
-            total_win_count += per['winCount']
-            total_reward += block.reward
-
-        tipset.total_win_count = total_win_count
-        tipset.total_reward = total_reward
-        tipset.save()
+                block, created = TipsetBlock.objects.get_or_create(
+                    block_hash=per['cid'], record_time=tipset.record_time
+                )
+                block.tipset = tipset
+                block.miner_address = per['miner']
+                block.msg_count = per['messageCount']
+                block.win_count = per['winCount']
+                block.reward = decimal.Decimal(per['reward']) + decimal.Decimal(per['penalty'])
+                block.height = height
+                block.save()
+
+                total_win_count += per['winCount']
+                total_reward += block.reward
+
+            tipset.total_win_count = total_win_count
+            tipset.total_reward = total_reward
+            tipset.save()
+            self.add_total_reward_delta(total_reward - old_total_reward)
         return format_return(0)
 
     def add_tipset(self, height, blocks=[]):
@@ -772,6 +803,7 @@ class TipsetBase(object):
                 tipset.total_reward += block.reward
 
             tipset.save()
+            self.add_total_reward_delta(tipset.total_reward)
             return 1
 
     def sync_tipset(self, date):
@@ -795,6 +827,8 @@ class TipsetBase(object):
         end_index = (end_date - launch_date).total_seconds() / 30
         end_index = max(int(end_index), 30)
 
+        # 每秒最多请求一次
+        rate_limiter = TokenBucket(rate=1)
         success_count = 0
         # 循环取
         for i in range(start_index, end_index + 30, page_count):
@@ -811,7 +845,7 @@ class TipsetBase(object):
                     height=height, blocks=tipset.get('blocks', [])
                 )
 
-            time.sleep(1)
+            rate_limiter.acquire()
 
         print('总耗时:', time.time() - _time_start, 's')
         return format_return(0, data={'success_count': success_count})
@@ -837,6 +871,9 @@ class TipsetBase(object):
 
         with transaction.atomic():
             tipset, created = Tipset.objects.get_or_create(height=height, record_time=record_time)
+            # 锁住高度再读旧的总奖励，并发写同一高度时差值不会重复累加
+            tipset = Tipset.objects.select_for_update().get(id=tipset.id)
+            old_total_reward = tipset.total_reward
 
             total_win_count = 0
             total_reward = 0
@@ -858,15 +895,79 @@ class TipsetBase(object):
             tipset.total_win_count = total_win_count
             tipset.total_reward = total_reward
             tipset.save()
+            self.add_total_reward_delta(total_reward - old_total_reward)
             return 1 if created else 0
 
-    def sync_tipset_2(self, date):
+    def add_tipsets_bulk(self, tipsets):
+        '''
+        批量添加一页高度，区块格式同add_tipset_2
+        tipsets: [(height, blocks), ...]
+        每页只查一次已有数据，新增用bulk_create、修改用bulk_update，返回新增的高度数
+        '''
+        if not tipsets:
+            return 0
+
+        # 主网启动时间
+        launch_date = datetime.datetime(2020, 8, 25, 6, 0, 0)
+        heights = [height for height, blocks in tipsets]
+        block_fields = ['tipset', 'miner_address', 'msg_count', 'win_count', 'reward', 'height']
+
+        with transaction.atomic():
+            existed_heights = set(Tipset.objects.filter(height__in=heights).values_list('height', flat=True))
+            Tipset.objects.bulk_create([
+                Tipset(height=height, record_time=launch_date + datetime.timedelta(seconds=30 * height))
+                for height in heights if height not in existed_heights
+            ], ignore_conflicts=True)
+            # 按高度顺序锁住整页再读旧的总奖励，避免并发写同一高度时差值重复累加
+            tipset_dict = dict([
+                (x.height, x) for x in Tipset.objects.select_for_update().filter(height__in=heights).order_by('height')
+            ])
+            old_total_reward = sum([x.total_reward for x in tipset_dict.values()])
+
+            block_hashes = [per['cid'] for height, blocks in tipsets for per in blocks]
+            block_dict = dict([(x.block_hash, x) for x in TipsetBlock.objects.filter(block_hash__in=block_hashes)])
+
+            new_blocks = []
+            update_blocks = []
+            for height, blocks in tipsets:
+                tipset = tipset_dict[height]
+                tipset.total_win_count = 0
+                tipset.total_reward = 0
+                for per in blocks:
+                    block = block_dict.get(per['cid'])
+                    if block:
+                        update_blocks.append(block)
+                    else:
+                        block = TipsetBlock(block_hash=per['cid'], record_time=tipset.record_time)
+                        block_dict[per['cid']] = block
+                        new_blocks.append(block)
+                    block.tipset = tipset
+                    block.miner_address = per['miner']
+                    block.msg_count = per['messageCount']
+                    block.win_count = per['winCount']
+                    block.reward = decimal.Decimal(per['reward']) + decimal.Decimal(per['penalty'])
+                    block.height = height
+
+                    tipset.total_win_count += per['winCount']
+                    tipset.total_reward += block.reward
+
+            TipsetBlock.objects.bulk_create(new_blocks, batch_size=1000)
+            TipsetBlock.objects.bulk_update(update_blocks, block_fields, batch_size=1000)
+            Tipset.objects.bulk_update(list(tipset_dict.values()), ['total_win_count', 'total_reward'], batch_size=1000)
+            self.add_total_reward_delta(sum([x.total_reward for x in tipset_dict.values()]) - old_total_reward)
+
+        return len(set(heights) - existed_heights)
+
+    def sync_tipset_2(self, date, is_bulk=True):
+        '''
+        同步一天的区块
+        is_bulk: 按页批量写入，否则逐个高度写入
+        '''
         # 同步开始时间
         _time_start = time.time()
         # 每页大小
         page_size = 100
 
-        now = datetime.datetime.now()
         # 主网启动时间
         launch_date = datetime.datetime(2020, 8, 25, 6, 0, 0)
         # 开始时间戳
@@ -877,37 +978,197 @@ class TipsetBase(object):
         end_date = start_date - datetime.timedelta(days=1)
         end_index = (end_date - launch_date).total_seconds() / 30
 
-        page_index = math.floor((now - start_date).total_seconds() / 30 / page_size) - 1
-        result = FilfoxBase().get_tipset_list(page_size=page_size, page_index=page_index)
-        while result['tipsets'][0]['height'] < temp_index:
-            page_index -= 5
-            page_index = max(0, page_index)
-            result = FilfoxBase().get_tipset_list(page_size=page_size, page_index=page_index)
+        # 每秒最多请求一次，定位分页的请求也受限速
+        rate_limiter = TokenBucket(rate=1)
+        page_index = self.find_tipset_page(height=temp_index, page_size=page_size, rate_limiter=rate_limiter)
         print(page_index, start_index, end_index)
+        if page_index is None:
+            return format_return(14004)
 
         success_count = 0
         while temp_index >= end_index:
             result = FilfoxBase().get_tipset_list(page_size=page_size, page_index=page_index)
             if result:
                 tipsets = result.get('tipsets')
+                tipset_dict = dict([(x['height'], x) for x in tipsets or []])
+                page_tipsets = []
                 while tipsets and temp_index >= tipsets[-1]['height']:
-                    temp = [x for x in tipsets if x['height'] == temp_index]
-                    # 找到
-                    if temp:
-                        success_count += self.add_tipset_2(height=temp_index, blocks=temp[0].get('blocks', []))
+                    # 没找到的高度按空块处理
+                    blocks = tipset_dict.get(temp_index, {}).get('blocks', [])
+                    if is_bulk:
+                        page_tipsets.append((int(temp_index), blocks))
                     else:
-                        success_count += self.add_tipset_2(height=temp_index, blocks=[])
+                        success_count += self.add_tipset_2(height=temp_index, blocks=blocks)
                     temp_index -= 1
+                success_count += self.add_tipsets_bulk(tipsets=page_tipsets)
             print(temp_index)
             page_index += 1
-            time.sleep(1)
+            rate_limiter.acquire()
 
         print('总耗时:', time.time() - _time_start, 's')
         return format_return(0, data={'success_count': success_count})
 
+    def get_tipset_page(self, page_index, page_size=100, sdk=None):
+        '''
+        获取一页高度，page_index从最新高度开始，高度倒序
+        '''
+        result = (sdk or FilfoxBase()).get_tipset_list(page_size=page_size, page_index=page_index)
+        return (result or {}).get('tipsets') or []
+
+    def find_tipset_page(self, height, page_size=100, sdk=None, rate_limiter=None, retries=3):
+        '''
+        二分查找第一个高度不小于height的最后一页，即包含height的页
+        每次请求都经过rate_limiter，请求失败时重试retries次，仍失败返回None，不能当作高度更低的页
+        '''
+
+        def _first_height(page_index):
+            for i in range(retries):
+                if rate_limiter:
+                    rate_limiter.acquire()
+                result = (sdk or FilfoxBase()).get_tipset_list(page_size=page_size, page_index=page_index)
+                if result:
+                    # 超出最早高度的页为空，当作高度更低的页
+                    tipsets = result.get('tipsets') or []
+                    return tipsets[0]['height'] if tipsets else -1
+            return None
+
+        head_height = _first_height(0)
+        if head_height is None:
+            return None
+        if head_height <= height:
+            return 0
+
+        # 按每页page_size个高度估算上界，空块会让实际页数偏小，不够再翻倍
+        low = 0
+        high = max(int((head_height - height) / page_size), 1)
+        while True:
+            first_height = _first_height(high)
+            if first_height is None:
+                return None
+            if first_height < height:
+                break
+            low = high
+            high *= 2
+
+        # _first_height(low) >= height > _first_height(high)
+        while high - low > 1:
+            middle = (low + high) // 2
+            first_height = _first_height(middle)
+            if first_height is None:
+                return None
+            if first_height >= height:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def refetch_tipset_page(self, page_index, height, page_size=100, sdk=None, rate_limiter=None):
+        '''
+        已取到的page_index页第一个高度小于height时重新取这一页，返回可以从height往下处理的页，确定不了时返回空列表
+        先取上一页再取这一页: 期间的新区块只会让分页整体移到更高的高度，
+        所以上一页最低高度大于height、这一页第一个高度仍小于height时，height在两页之间，是空块
+        '''
+        if page_index <= 0:
+            return []
+        if rate_limiter:
+            rate_limiter.acquire()
+        prev_tipsets = self.get_tipset_page(page_index=page_index - 1, page_size=page_size, sdk=sdk)
+        if rate_limiter:
+            rate_limiter.acquire()
+        tipsets = self.get_tipset_page(page_index=page_index, page_size=page_size, sdk=sdk)
+        if not tipsets:
+            return []
+        if tipsets[0]['height'] >= height or (prev_tipsets and prev_tipsets[-1]['height'] > height):
+            return tipsets
+        return []
+
+    def backfill_tipset(self, date, page_size=100, max_workers=4, rate=2, sdk=None):
+        '''
+        回填一天的区块，范围同sync_tipset_2
+        并发取页并限速，每写完一页记录已完成的最低高度，中断后再次调用从断点继续
+        '''
+        _time_start = time.time()
+        # 主网启动时间
+        launch_date = datetime.datetime(2020, 8, 25, 6, 0, 0)
+        start_date = datetime.datetime.strptime(date, '%Y-%m-%d')
+        start_index = int((start_date - launch_date).total_seconds() / 30)
+        end_index = int((start_date - datetime.timedelta(days=1) - launch_date).total_seconds() / 30)
+
+        cache_obj = cache.Cache()
+        checkpoint_key = 'calculator_tipset_backfill_%s' % date
+        checkpoint = cache_obj.get(key=checkpoint_key)
+        temp_index = checkpoint - 1 if checkpoint is not None else start_index
+
+        rate_limiter = TokenBucket(rate=rate, capacity=max_workers)
+        success_count = 0
+        failed_count = 0
+        shift_count = 0
+        page_index = None
+        if temp_index >= end_index:
+            page_index = self.find_tipset_page(height=temp_index, page_size=page_size, sdk=sdk, rate_limiter=rate_limiter)
+        # 定位不到分页时停止，下次调用从断点继续
+        while page_index is not None and temp_index >= end_index and failed_count < 5 and shift_count < 20:
+            pages = fetch_concurrently(
+                func=self.get_tipset_page, max_workers=max_workers, rate_limiter=rate_limiter,
+                params_list=[{'page_index': page_index + i, 'page_size': page_size, 'sdk': sdk} for i in range(max_workers)]
+            )
+            for tipsets in pages:
+                # 取页失败，下一轮从这一页重试
+                if not tipsets:
+                    failed_count += 1
+                    break
+
+                page_tipsets = []
+                if temp_index > tipsets[0]['height']:
+                    # 本页从temp_index以下开始，可能是并发取页时分页移动了: 重新取页确认，确认不了则重新定位
+                    tipsets = self.refetch_tipset_page(page_index=page_index, height=temp_index, page_size=page_size, sdk=sdk, rate_limiter=rate_limiter)
+                    if not tipsets:
+                        shift_count += 1
+                        page_index = self.find_tipset_page(height=temp_index, page_size=page_size, sdk=sdk, rate_limiter=rate_limiter)
+                        break
+                    # 和上一页之间的高度是空块
+                    while temp_index >= end_index and temp_index > tipsets[0]['height']:
+                        page_tipsets.append((temp_index, []))
+                        temp_index -= 1
+
+                # 新区块会让分页后移，已处理过的高度直接跳过
+                tipset_dict = dict([(x['height'], x) for x in tipsets])
+                while temp_index >= max(tipsets[-1]['height'], end_index):
+                    # 没找到的高度按空块处理
+                    page_tipsets.append((temp_index, tipset_dict.get(temp_index, {}).get('blocks', [])))
+                    temp_index -= 1
+                success_count += self.add_tipsets_bulk(tipsets=page_tipsets)
+                if page_tipsets:
+                    cache_obj.set(key=checkpoint_key, value=temp_index + 1, time_out=7 * 24 * 60 * 60)
+
+                page_index += 1
+                if temp_index < end_index:
+                    break
+
+        print('回填%s总耗时:' % date, time.time() - _time_start, 's')
+        return format_return(0, data={
+            'success_count': success_count, 'last_height': temp_index + 1, 'finished': temp_index < end_index
+        })
+
+    def backfill_tipsets(self, start_date, end_date, page_size=100, max_workers=4, rate=2, sdk=None):
+        '''
+        回填[start_date, end_date]每天的区块
+        '''
+        date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+        data = {}
+        while date <= end_date:
+            result = self.backfill_tipset(
+                date=date.strftime('%Y-%m-%d'), page_size=page_size, max_workers=max_workers, rate=rate, sdk=sdk
+            )
+            data[date.strftime('%Y-%m-%d')] = result['data']
+            date += datetime.timedelta(days=1)
+        return format_return(0, data=data)
+
     def sync_temp_tipset(self):
         '''
         同步临时区块
+        和本次返回的高度上已有的block_hash比对，只写入缺少的区块，晚到的奖励和同高度的兄弟区块也会补上
         '''
         result = FilfoxBase().get_tipset_list(page_size=100)
         if not result:
@@ -918,35 +1179,187 @@ class TipsetBase(object):
 
         # 清除24小时以前的数据
         yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-        TempTipsetBlock.objects.filter(record_time__lt=yesterday).delete()
+        purge_count = self.purge_temp_tipset_blocks(before=yesterday)
+
+        tipsets = result.get('tipsets', [])
+        existed = set(
+            TempTipsetBlock.objects.filter(height__in=[x['height'] for x in tipsets]).values_list('block_hash', flat=True)
+        ) if tipsets else set()
 
-        for tipset in result.get('tipsets', []):
+        blocks = []
+        for tipset in tipsets:
             height = tipset['height']
             record_time = launch_date + datetime.timedelta(seconds=30 * height)
 
             for per in tipset.get('blocks', []):
-                if not per.get('reward'):
+                if not per.get('reward') or per['cid'] in existed:
                     continue
-                block, c = TempTipsetBlock.objects.get_or_create(
-                    block_hash=per['cid'], record_time=record_time
-                )
-                block.miner_address = per['miner']
-                block.msg_count = per['messageCount']
-                block.win_count = per['winCount']
-                block.reward = decimal.Decimal(per['reward']) + decimal.Decimal(per['penalty'])
-                block.height = height
-                block.save()
+                existed.add(per['cid'])
+                blocks.append(TempTipsetBlock(
+                    block_hash=per['cid'], record_time=record_time, miner_address=per['miner'],
+                    msg_count=per['messageCount'], win_count=per['winCount'],
+                    reward=decimal.Decimal(per['reward']) + decimal.Decimal(per['penalty']), height=height
+                ))
+        TempTipsetBlock.objects.bulk_create(blocks, batch_size=1000, ignore_conflicts=True)
+
+        # 滚动幸运值跟随新区块更新，补了区块的高度重新汇总整个高度的赢票数
+        heights = set([x.height for x in blocks])
+        height_win_counts = dict(
+            TempTipsetBlock.objects.filter(height__in=heights).values('height').annotate(win_count=Sum('win_count'))
+            .values_list('height', 'win_count')
+        ) if heights else {}
+        min_height = int(math.ceil((yesterday - launch_date).total_seconds() / 30))
+        LookupBase().update_rolling_luck(height_win_counts=height_win_counts, min_height=min_height)
+
+        return format_return(0, data={'add_count': len(blocks), 'purge_count': purge_count})
+
+    def purge_temp_tipset_blocks(self, before, chunk_size=5000):
+        '''
+        按record_time索引分批删除过期的临时区块，每次最多删除chunk_size条
+        '''
+        count = 0
+        while True:
+            ids = list(
+                TempTipsetBlock.objects.filter(record_time__lt=before).order_by('record_time')
+                .values_list('id', flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            count += TempTipsetBlock.objects.filter(id__in=ids).delete()[0]
+        return count
 
-        return format_return(0)
+    def add_total_reward_delta(self, delta):
+        '''
+        按增量更新区块奖励累计账本，需在写入区块的同一事务内调用
+        账本未初始化时跳过，由对账时初始化
+        '''
+        if not delta:
+            return
+        TipsetRewardLedger.objects.filter(name=TOTAL_REWARD_LEDGER).update(
+            total_reward=F('total_reward') + delta, update_time=datetime.datetime.now()
+        )
+
+    def reconcile_total_rewards(self):
+        '''
+        对账：锁住账本后用全表求和核对，记录检查点，不一致时以求和结果修正账本
+        '''
+        with transaction.atomic():
+            ledger, created = TipsetRewardLedger.objects.select_for_update().get_or_create(name=TOTAL_REWARD_LEDGER)
+            result = Tipset.objects.aggregate(sum_reward=Sum('total_reward'), max_height=Max('height'))
+            sum_reward = result['sum_reward'] or 0
+            difference = sum_reward - ledger.total_reward
+            TipsetRewardCheckpoint.objects.create(
+                max_height=result['max_height'] or 0, ledger_reward=ledger.total_reward,
+                sum_reward=sum_reward, difference=difference
+            )
+            if difference:
+                ledger.total_reward = sum_reward
+                ledger.save()
+        return format_return(0, data={'total_reward': sum_reward, 'difference': difference, 'created': created})
 
     def get_total_rewards(self):
-        return Tipset.objects.filter().aggregate(Sum('total_reward'))['total_reward__sum'] or 0
+        '''
+        累计区块奖励，直接读账本
+        '''
+        ledger = TipsetRewardLedger.objects.filter(name=TOTAL_REWARD_LEDGER).first()
+        if not ledger:
+            return self.reconcile_total_rewards()['data']['total_reward']
+        return ledger.total_reward
 
 
 def _d(num):
     return decimal.Decimal(num)
 
 
+# 每日区块奖励，见CalculatorBase.get_day_block_reward
+_day_block_reward_table = {}
+# 对照预测默认的计算方式: decimal 或 array(需要numpy)
+LOOKUP_BACKEND = os.getenv('CALCULATOR_LOOKUP_BACKEND', 'decimal')
+# 每日简单奖励表覆盖的年数
+SIMPLE_REWARD_TABLE_YEARS = 10
+# 每日简单奖励表，见LookupBase.get_simple_reward_table
+_simple_reward_table = []
+# 预测段天数的取整步长，见LookupBase.get_lookups
+LOOKUP_HORIZON_STEP = 30
+# 对照表按列缓存的字段
+LOOKUP_SCHEMA = [('day', 'int'), ('date', 'date')] + [(x, 'decimal') for x in (
+    'power', 'limit_power', 'sum_power', 'kpi_time', 'kpi_power', 'sum_baseline_reward', 'luck_v', 'increase_power',
+    'packing_power', 'baseline_reward', 'simple_reward', 'reward', 'reward_by_luck', 'avg_reward', 'base_fee',
+    'circulating_supply', 'create_gas', 'keep_gas', 'official_release', 'penalty_gas', 'day_release',
+    'day_line_release', 'day_line_release_sum', 'miner_release', 'avg_pledge', 'pledge', 'sum_pledge'
+)]
+# generate_lookup输出的字段格式
+LOOKUP_DETAIL_FORMATTER = RowFormatter(
+    [('date', 'date', lambda x: x.strftime('%Y-%m-%d'))] +
+    [(x, x, lambda value: format_price(value, 2)) for x in ('today_new_power', 'today_power')] +
+    [(x, x, lambda value: format_price(value, 8)) for x in (
+        'reward_per_day', 'pledge_per_day', 'today_pledge', 'today_reward_base', 'today_reward', 'today_release',
+        'today_release_principal', 'total_pledge', 'total_reward', 'total_release', 'total_release_principal',
+        'total_already_release', 'create_cost_gas_per_t', 'create_cost_gas_per_t_64', 'keep_cost_gas_per_t',
+        'keep_cost_gas_per_t_64', 'create_gas', 'keep_gas', 'total_keep_gas'
+    )]
+)
+# 区块奖励累计账本名称，见TipsetBase.get_total_rewards
+TOTAL_REWARD_LEDGER = 'total_reward'
+
+
+class GasStatBase(object):
+    '''
+    gas统计
+    滚动均值各用一次聚合查询算出，缓存到下次sync_gas_fee、sync_total_power_day_record
+    '''
+
+    def __init__(self, days=7):
+        # 滚动天数
+        self.days = days
+
+    def get_avg_create_gas_by_day(self):
+        '''
+        单T生产gas: PreCommitSector、ProveCommitSector 每天 总手续费/消息数 的均值之和
+        缺少某天的数据时按已有天数取均值
+        '''
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        records = GasFeeDay.objects.filter(
+            date__gte=today - datetime.timedelta(days=self.days), date__lt=today,
+            method__in=['PreCommitSector', 'ProveCommitSector'], count__gt=0
+        ).values('method').annotate(
+            avg_fee=Avg(F('total_fee') / F('count'), output_field=DecimalField(max_digits=34, decimal_places=6))
+        )
+        total = sum([_d(per['avg_fee']) for per in records])
+        return total / _d(10**18) * 32
+
+    def get_avg_keep_gas_by_day(self):
+        '''
+        单T维护gas: 最近几天 时空证明总gas/全网算力(TiB) 的均值
+        只取两列，在Python里按Decimal逐天相除，结果和以前逐条计算一致，不受数据库除法精度影响
+        '''
+        records = list(TotalPowerDay.objects.filter(power__gt=0).values_list('submit_windowed_po_st_total_gas', 'power')[:self.days])
+        if not records:
+            return _d(0)
+        total = sum([_d(gas / (power / _d(1024**4))) for gas, power in records])
+        return _d(total / len(records))
+
+    @cache_required(cache_key='calculator_avg_gas_stat', expire=24 * 60 * 60)
+    def get_avg_gas_stat(self, must_update_cache=False):
+        '''
+        获取对照计算用的gas滚动均值，供get_lookups
+        '''
+        return {
+            'avg_create_gas': self.get_avg_create_gas_by_day(),
+            'avg_keep_gas': self.get_avg_keep_gas_by_day()
+        }
+
+    @cache_required(cache_key='calculator_gas_cost_info', expire=30 * 60)
+    def get_gas_cost_info(self, must_update_cache=False):
+        '''
+        获取当前单T生产/维护gas，供generate_lookup，和概览一样30分钟更新
+        '''
+        return {
+            'gas_info_32': inner_server.get_gas_cost_stat({'sector_type': '0'}).get('data', {}),
+            'gas_info_64': inner_server.get_gas_cost_stat({'sector_type': '1'}).get('data', {})
+        }
+
+
 class LookupBase():
 
     def __init__(self):
@@ -962,6 +1375,10 @@ class LookupBase():
         self.simple_minted = _d(330000000)
         # 奖励释放天数
         self.release_days = 180
+        # 历史对照计算结果，算法变化时修改版本号
+        self.cache_key_history_state = 'calculator_history_lookups_state_v2'
+        # 最近24小时滚动幸运值
+        self.cache_key_rolling_luck = 'calculator_rolling_luck_v1'
 
     def get_kpi_power(self, block_num):
         return self.net_baseline_power_p * _d(math.pow(2, block_num / 365 / 2880) * math.pow(1024, 5))
@@ -975,23 +1392,52 @@ class LookupBase():
         '''
         return self.simple_minted * _d(math.exp(-1.09897764548444e-7 * block_num) * (1.09897764548444e-7))
 
+    def get_sum_simple_reward(self, start_index, end_index):
+        '''
+        区间[start_index, end_index)的简单奖励之和
+        get_simple_reward是等比数列，直接用求和公式代替逐个高度累加
+        '''
+        count = end_index - start_index
+        if count <= 0:
+            return _d(0)
+        rate = 1.09897764548444e-7
+        return self.simple_minted * _d(
+            rate * math.exp(-rate * start_index) * math.expm1(-rate * count) / math.expm1(-rate)
+        )
+
+    def get_day_simple_reward(self, run_days):
+        '''
+        获取主网运行第run_days天的简单奖励
+        '''
+        # 第一天特殊处理，主网6点启动，当天只有2160个高度
+        if run_days == 0:
+            return self.get_sum_simple_reward(start_index=0, end_index=2160)
+        # 之后每天0点的高度
+        start_index = run_days * 2880 - 720
+        return self.get_sum_simple_reward(start_index=start_index, end_index=start_index + 2880)
+
+    def get_simple_reward_table(self):
+        '''
+        主网启动后SIMPLE_REWARD_TABLE_YEARS年内的每日简单奖励，按运行天数索引，每个进程只计算一次
+        '''
+        if not _simple_reward_table:
+            _simple_reward_table.extend(
+                self.get_day_simple_reward(run_days=i) for i in range(SIMPLE_REWARD_TABLE_YEARS * 366)
+            )
+        return _simple_reward_table
+
     def get_date_simple_reward(self, date):
         '''
         获取指定日期的简单奖励
         '''
         start_date = datetime.datetime(date.year, date.month, date.day)
-        # 第一天特殊处理
-        if start_date.strftime('%Y-%m-%d') == self.launch_date.strftime('%Y-%m-%d'):
-            start_index = 0
-            end_index = 2160
-        else:
-            start_index = int((start_date - self.launch_date).total_seconds() / 30)
-            end_index = start_index + 2880
+        launch_date = datetime.datetime(self.launch_date.year, self.launch_date.month, self.launch_date.day)
+        run_days = (start_date - launch_date).days
 
-        simple_reward = 0
-        for i in range(start_index, end_index):
-            simple_reward += self.get_simple_reward(block_num=i)
-        return simple_reward
+        table = self.get_simple_reward_table()
+        if 0 <= run_days < len(table):
+            return table[run_days]
+        return self.get_day_simple_reward(run_days=run_days)
 
     def get_baseline_reward(self, block_num):
         '''
@@ -1016,35 +1462,53 @@ class LookupBase():
     def get_luck_v(self, date=None):
         '''
         获取幸运值
+        按天使用Tipset上入库时汇总好的total_win_count，只统计出了块的高度
+        不传日期时使用最近24小时的滚动值
         '''
         if date:
             start_date = date.strftime('%Y-%m-%d') + ' 00:00:00'
             end_date = (date + datetime.timedelta(days=1)).strftime('%Y-%m-%d') + ' 00:00:00'
-
-            sql = """
-                SELECT height, SUM(win_count)
-                FROM calculator_tipsetblock
-                WHERE %s <= record_time AND record_time < %s
-                GROUP BY height
-            """
-            records = raw_sql.exec_sql(sql, [start_date, end_date])
+            result = Tipset.objects.filter(
+                record_time__gte=start_date, record_time__lt=end_date, total_win_count__gt=0
+            ).aggregate(sum_win_count=Sum('total_win_count'), height_count=Count('id'))
         else:
-            sql = """
-                SELECT height, SUM(win_count)
-                FROM calculator_temptipsetblock
-                GROUP BY height
-            """
-            records = raw_sql.exec_sql(sql)
-        if not records:
+            result = cache.Cache().get(key=self.cache_key_rolling_luck)
+            if not result:
+                result = TempTipsetBlock.objects.filter(win_count__gt=0).aggregate(
+                    sum_win_count=Sum('win_count'), height_count=Count('height', distinct=True)
+                )
+        if not result.get('height_count'):
             return _d(1)
 
-        sum_win_count = 0
-        for per in records:
-            sum_win_count += per[1]
-
-        luck_v = _d(sum_win_count / len(records) / 5)
+        luck_v = _d(result['sum_win_count']) / result['height_count'] / 5
         return min(1, luck_v)
 
+    def update_rolling_luck(self, height_win_counts, min_height):
+        '''
+        区块入库时更新最近24小时的滚动幸运值
+        height_win_counts: {高度: 该高度的总赢票数}，只包含有新入库区块的高度
+        min_height: 窗口内的最低高度，低于它的高度移出窗口
+        缓存失效时从临时区块表重建
+        '''
+        cache_obj = cache.Cache()
+        state = cache_obj.get(key=self.cache_key_rolling_luck)
+        if state:
+            heights = state['heights']
+            heights.update(height_win_counts)
+        else:
+            heights = dict(
+                TempTipsetBlock.objects.values('height').annotate(win_count=Sum('win_count'))
+                .values_list('height', 'win_count')
+            )
+        heights = {height: win_count for height, win_count in heights.items() if height >= min_height and win_count}
+        state = {
+            'heights': heights,
+            'sum_win_count': sum(heights.values()),
+            'height_count': len(heights)
+        }
+        cache_obj.set(key=self.cache_key_rolling_luck, value=state, time_out=24 * 60 * 60)
+        return state
+
     def get_sum_power(self, date):
         '''
         历史所有算力总和
@@ -1085,19 +1549,7 @@ class LookupBase():
 
     def get_avg_create_gas(self):
         '''获取平均生成gas'''
-        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        total = 0
-        # 获取7天平均值
-        for i in range(7):
-            today -= datetime.timedelta(days=1)
-            temp = GasFeeDay.objects.filter(date=today, method='PreCommitSector')[0]
-            avg_pre = (temp.total_fee / 10**18) / temp.count
-            temp = GasFeeDay.objects.filter(date=today, method='ProveCommitSector')[0]
-            avg_prove = (temp.total_fee / 10**18) / temp.count
-
-            total += _d(avg_pre + avg_prove)
-
-        return _d(total / 7 * 32)
+        return GasStatBase().get_avg_gas_stat()['avg_create_gas']
 
     def get_create_gas(self, avg_create_gas, increase_power):
         '''
@@ -1109,12 +1561,7 @@ class LookupBase():
 
     def get_avg_keep_gas(self):
         '''获取平均维护gas'''
-        total = 0
-        # 获取7天平均值
-        for per in TotalPowerDay.objects.filter()[:7]:
-            total += _d(per.submit_windowed_po_st_total_gas / (per.power / _d(1024**4)))
-
-        return _d(total / 7)
+        return GasStatBase().get_avg_gas_stat()['avg_keep_gas']
 
     def get_keep_gas(self, avg_keep_gas, power):
         '''
@@ -1131,22 +1578,40 @@ class LookupBase():
         '''
         return _d(6.845 / math.pow(10, 6)) * base_fee + _d(10752)
 
-    @cache_required(cache_key='calculator_history_lookups', expire=30 * 60)
+    @cache_required(cache_key='calculator_history_lookups_v2', expire=30 * 60)
     def get_history_lookups(self, must_update_cache=False):
         '''
-        获取历史对照
+        获取历史对照，返回按列存储的ColumnarRows
+        计算结果按列存储持久化到缓存，只从最早有变化的TotalPowerDay开始重新计算
         '''
-        lookups = []
+        cache_obj = cache.Cache()
+        state = cache_obj.get(key=self.cache_key_history_state) or {}
+        lookups = state.get('lookups') or ColumnarRows(LOOKUP_SCHEMA)
+        versions = state.get('versions') or []
+
+        # 按日期的(日期, 修改时间)，找出第一条新增或修改的记录
+        records = TotalPowerDay.objects.filter().order_by('date')
+        current_versions = list(records.values_list('date', 'update_time'))
         index = 0
-        for per in TotalPowerDay.objects.filter().order_by('date'):
+        while index < min(len(versions), len(current_versions), len(lookups)) and versions[index] == current_versions[index]:
+            index += 1
+        if index == len(current_versions) and index == len(lookups):
+            return lookups
+
+        lookups = lookups[:index]
+        sum_power = sum(lookups.column('limit_power'))
+        sum_pledge = sum(lookups.column('pledge'))
+        prev_sum_baseline_reward = lookups.get_value('sum_baseline_reward', index - 1) if index > 0 else _d(0)
+        # 最近release_days天的线性释放，用来算累计线性释放
+        day_line_releases = lookups[-self.release_days:].column('day_line_release')
+        news = []
+        for per in records[index:]:
             # sum_power = self.get_sum_power(date=per.date)
-            sum_power = sum([x['limit_power'] for x in lookups])
             kpi_power = self.get_kpi_power_per_day(day=index)
             kpi_time = self.get_kpi_time(sum_power=sum_power / _d(math.pow(1024, 5)))
             sum_baseline_reward = self.get_sum_baseline_reward(time=kpi_time)
             simple_reward = self.get_date_simple_reward(date=per.date)
             official_release = self.get_official_release(date=per.date)
-            prev_sum_baseline_reward = lookups[index - 1]['sum_baseline_reward'] if index > 0 else _d(0)
             baseline_reward = sum_baseline_reward - prev_sum_baseline_reward
             reward = baseline_reward + simple_reward
             reward_by_luck = reward * per.luck
@@ -1188,29 +1653,40 @@ class LookupBase():
                 'avg_pledge': per.avg_pledge * _d(32),
                 'pledge': per.avg_pledge * _d(32) * (per.increase_power / _d(math.pow(1024, 4)))
             }
-            lookups.append(temp)
+            news.append(temp)
 
             # 前180天累计线性释放
-            temp['day_line_release_sum'] = sum([x['day_line_release'] for x in lookups[-self.release_days:-1]])
+            day_line_releases = (day_line_releases + [day_line_release])[-self.release_days:]
+            temp['day_line_release_sum'] = sum(day_line_releases[:-1])
             # 挖矿释放
             temp['miner_release'] = day_release + temp['day_line_release_sum']
             # 修正质押, 当日质押 + (奖励 - 挖矿释放)
             temp['pledge'] += temp['reward_by_luck'] - temp['miner_release']
-            # 总质押量
-            temp['sum_pledge'] = sum([x['pledge'] for x in lookups])
+            # 历史汇总算力、总质押量
+            sum_power += temp['limit_power']
+            sum_pledge += temp['pledge']
+            temp['sum_pledge'] = sum_pledge
 
+            prev_sum_baseline_reward = sum_baseline_reward
             index += 1
 
+        lookups = lookups + ColumnarRows.from_rows(news, LOOKUP_SCHEMA)
+        cache_obj.set(
+            key=self.cache_key_history_state, value={'versions': current_versions, 'lookups': lookups},
+            time_out=30 * 24 * 60 * 60
+        )
         return lookups
 
-    @cache_required(cache_key='calculator_lookups_%s', expire=2 * 60 * 60)
-    def get_lookups(self, ck='', luck_v='', increase_power='', days=540,  must_update_cache=False):
+    def get_lookups(self, ck='', luck_v='', increase_power='', days=540,  must_update_cache=False, backend=None):
         '''
         获取对照
+        两级缓存: 历史对照见get_history_lookups；预测段按(计算方式, 幸运值, 算力增速)缓存，
+        按请求过的最长天数计算，天数更短的请求直接截取，更长的请求延长预测段后覆盖缓存
+        返回按列存储的ColumnarRows，需要dict时用to_rows
+        ck: 兼容旧的调用方式，不再使用
+        backend: decimal 逐日Decimal计算(对账用)，array 使用numpy按列计算，默认取LOOKUP_BACKEND
         '''
         _time_start = time.time()
-        offset_day = 20
-        lookups = []
         history_lookups = self.get_history_lookups(must_update_cache=must_update_cache)
 
         # 算力增速，取7天均值
@@ -1219,14 +1695,54 @@ class LookupBase():
         increase_power = _d(avg_increase_power) if increase_power is None else increase_power * _d(math.pow(1024, 5))
         # 幸运值
         luck_v = _d(luck_v or self.get_luck_v())
+        # 缓存按归一化后的参数区分: 幸运值保留8位小数，算力增速取整字节
+        luck_v = luck_v.quantize(_d('0.00000001'))
+        increase_power = increase_power.quantize(_d(1))
         # 实时base_fee
         current_base_fee = self.current_base_fee()
+        # 平均成产gas、平均维护gas
+        gas_stat = GasStatBase().get_avg_gas_stat()
+        avg_create_gas = gas_stat['avg_create_gas']
+        avg_keep_gas = gas_stat['avg_keep_gas']
+
+        backend = 'array' if (backend or LOOKUP_BACKEND) == 'array' and np is not None else 'decimal'
+        # 预测段依赖的输入，任一变化则重新计算
+        last_day = history_lookups[-1]
+        version = (
+            len(history_lookups), last_day['date'], last_day['sum_power'], last_day['sum_pledge'],
+            last_day['circulating_supply'], last_day['base_fee'], current_base_fee, avg_create_gas, avg_keep_gas
+        )
+        segment_key = 'calculator_lookups_segment_v2_%s_%s_%s' % (backend, luck_v, increase_power)
+        cache_obj = cache.Cache()
+        segment = cache_obj.get(key=segment_key)
+        if must_update_cache or not segment or segment['version'] != version:
+            segment = {'version': version, 'days': 0, 'lookups': []}
+
+        if segment['days'] < days:
+            # 按步长向上取整，按天推移的未来日期请求不用每次都重新计算
+            horizon = max(int(math.ceil(days / LOOKUP_HORIZON_STEP)) * LOOKUP_HORIZON_STEP, segment['days'])
+            params = {
+                'history_lookups': history_lookups, 'luck_v': luck_v, 'increase_power': increase_power, 'days': horizon,
+                'current_base_fee': current_base_fee, 'avg_create_gas': avg_create_gas, 'avg_keep_gas': avg_keep_gas
+            }
+            if backend == 'array':
+                lookups = self.project_lookups_by_array(**params)
+            else:
+                lookups = self.project_lookups(**params)
+            segment['lookups'] = ColumnarRows.from_rows(lookups, LOOKUP_SCHEMA)
+            segment['days'] = horizon
+            cache_obj.set(key=segment_key, value=segment, time_out=2 * 60 * 60)
+
+        print('对照总耗时:', time.time() - _time_start, 's')
+        return history_lookups + segment['lookups'][:max(days, 0)]
+
+    def project_lookups(self, history_lookups, luck_v, increase_power, days, current_base_fee, avg_create_gas, avg_keep_gas, offset_day=20):
+        '''
+        逐日预测未来days天的对照
+        '''
+        lookups = []
         # 昨天base_fee
         yesterday_base_fee = history_lookups[-1]['base_fee']
-        # 平均成产gas
-        avg_create_gas = self.get_avg_create_gas()
-        # 平均维护gas
-        avg_keep_gas = self.get_avg_keep_gas()
 
         lookups.append(history_lookups[-1])
         for i in range(1, days + offset_day + 1):
@@ -1331,5 +1847,132 @@ class LookupBase():
 
             i += 1
 
-        print('对照总耗时:', time.time() - _time_start, 's')
-        return history_lookups + lookups[1:-offset_day]
+        return lookups[1:-offset_day]
+
+    def get_lookup_columns_by_array(self, history_lookups, luck_v, increase_power, days, current_base_fee, avg_create_gas, avg_keep_gas, offset_day=20):
+        '''
+        按列预测未来days天的对照，返回numpy数组
+        算力、kpi、奖励、释放窗口、质押都是整列计算，只有流通量的递推需要逐日循环
+        '''
+        last_day = history_lookups[-1]
+        rows = days + offset_day
+        pib = math.pow(1024, 5)
+        tib = math.pow(1024, 4)
+        ln2 = math.log(2)
+        luck_v = float(luck_v)
+        increase_power = float(increase_power)
+        increase_power_t = increase_power / tib
+
+        offsets = np.arange(1, rows + 1)
+        dates = [last_day['date'] + datetime.timedelta(days=int(i)) for i in offsets]
+        run_days = (dates[0] - self.launch_date.date()).days + offsets - 1
+
+        # 基线算力值
+        kpi_power = float(self.net_baseline_power_p) * np.power(2.0, run_days / 365) * pib
+        # 预测今日算力，不能超过kpi算力
+        power = np.maximum(float(last_day['power']) + offsets * increase_power, 0)
+        limit_power = np.minimum(power, kpi_power)
+        sum_power = float(last_day['sum_power']) + np.cumsum(limit_power)
+        # 有效时间、累计基线奖励
+        kpi_time = 365 / ln2 * np.log(1 + ln2 * (sum_power / pib) / (365 * float(self.net_baseline_power_p)))
+        sum_baseline_reward = float(self.baseline_minted) * -np.expm1(-kpi_time * (ln2 / (6 * 365)))
+        baseline_reward = np.maximum(np.diff(sum_baseline_reward, prepend=float(last_day['sum_baseline_reward'])), 0)
+        # 简单奖励
+        simple_reward = np.array([float(self.get_day_simple_reward(run_days=int(x))) for x in run_days])
+        reward = simple_reward + baseline_reward
+        reward_by_luck = reward * luck_v
+        avg_reward = np.divide(reward_by_luck, power / tib, out=np.zeros(rows), where=power != 0)
+        official_release = np.array([float(self.get_official_release(date=x)) for x in dates])
+        day_release = reward_by_luck * 0.25
+        day_line_release = reward_by_luck * 0.75 / self.release_days
+
+        # 只有前days天需要计算释放和质押，后offset_day天用于质押的收益预估
+        count = days
+        day_index = run_days[:count]
+        # 前180天累计线性释放，历史 + 预测按天拼接后用前缀和取窗口
+        line_release = np.concatenate([[float(x['day_line_release']) for x in history_lookups], day_line_release])
+        line_release_sum = np.concatenate([[0], np.cumsum(line_release)])
+        end_index = np.minimum(day_index, len(line_release))
+        start_index = np.minimum(np.maximum(day_index - self.release_days, 0), end_index)
+        day_line_release_sum = line_release_sum[end_index] - line_release_sum[start_index]
+        miner_release = day_release[:count] + day_line_release_sum
+        # sum(当日单T收益...未来19天单T收益)
+        avg_reward_sum = np.concatenate([[0], np.cumsum(avg_reward)])
+        sum_reward = avg_reward_sum[np.arange(count) + offset_day] - avg_reward_sum[np.arange(count)]
+        max_power_t = np.maximum(power[:count], kpi_power[:count]) / tib
+
+        create_gas = float(avg_create_gas) * increase_power_t
+        keep_gas = float(avg_keep_gas) * power[:count] / tib
+        penalty_gas = float(self.get_penalty_gas(base_fee=current_base_fee))
+        # 流通量递推: 今日流通量 = 昨日流通量 * (1 - 0.3 * 算力增量 / max_power) + 其余部分
+        const_offset = official_release[:count] + 2 * miner_release - sum_reward * increase_power_t - reward_by_luck[:count] \
+            - create_gas - keep_gas - penalty_gas + 5000
+        rate = 1 - 0.3 * increase_power_t / max_power_t
+        circulating_supply = np.zeros(count)
+        prev_circulating_supply = float(last_day['circulating_supply']) / math.pow(10, 18)
+        for i in range(count):
+            prev_circulating_supply = prev_circulating_supply * rate[i] + const_offset[i]
+            circulating_supply[i] = prev_circulating_supply
+        prev_circulating_supply = np.concatenate([[float(last_day['circulating_supply']) / math.pow(10, 18)], circulating_supply[:-1]])
+
+        avg_pledge = sum_reward + 0.3 * prev_circulating_supply / max_power_t
+        pledge = avg_pledge * increase_power_t + reward_by_luck[:count] - miner_release
+        # 总质押量，不含当天
+        pledge_all = np.concatenate([[float(x['pledge']) for x in history_lookups], pledge])
+        pledge_sum = np.concatenate([[0], np.cumsum(pledge_all)])
+        sum_pledge = pledge_sum[np.minimum(day_index, len(pledge_all))]
+
+        return {
+            'date': dates[:count],
+            'day': day_index,
+            'power': power[:count],
+            'limit_power': limit_power[:count],
+            'sum_power': sum_power[:count],
+            'kpi_time': kpi_time[:count],
+            'kpi_power': kpi_power[:count],
+            'sum_baseline_reward': sum_baseline_reward[:count],
+            'baseline_reward': baseline_reward[:count],
+            'simple_reward': simple_reward[:count],
+            'reward': reward[:count],
+            'reward_by_luck': reward_by_luck[:count],
+            'avg_reward': avg_reward[:count],
+            'official_release': official_release[:count],
+            'day_release': day_release[:count],
+            'day_line_release': day_line_release[:count],
+            'day_line_release_sum': day_line_release_sum,
+            'miner_release': miner_release,
+            'avg_pledge': avg_pledge,
+            'pledge': pledge,
+            'sum_pledge': sum_pledge,
+            'create_gas': np.full(count, create_gas),
+            'keep_gas': keep_gas,
+            'penalty_gas': np.full(count, penalty_gas),
+            'circulating_supply': circulating_supply * math.pow(10, 18)
+        }
+
+    def project_lookups_by_array(self, history_lookups, luck_v, increase_power, days, current_base_fee, avg_create_gas, avg_keep_gas, offset_day=20):
+        '''
+        按列预测未来days天的对照，结果与project_lookups格式一致
+        '''
+        columns = self.get_lookup_columns_by_array(
+            history_lookups=history_lookups, luck_v=luck_v, increase_power=increase_power, days=days,
+            current_base_fee=current_base_fee, avg_create_gas=avg_create_gas, avg_keep_gas=avg_keep_gas,
+            offset_day=offset_day
+        )
+        yesterday_base_fee = history_lookups[-1]['base_fee']
+        keys = [x for x in columns if x not in ('date', 'day')]
+
+        lookups = []
+        for i in range(len(columns['date'])):
+            temp = {
+                'day': int(columns['day'][i]),
+                'date': columns['date'][i],
+                'luck_v': luck_v,
+                'increase_power': increase_power,
+                'packing_power': increase_power,
+                'base_fee': yesterday_base_fee
+            }
+            for key in keys:
+                temp[key] = _d(float(columns[key][i]))
+            lookups.append(temp)
+        return lookups
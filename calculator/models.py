@@ -34,7 +34,7 @@ class Tipset(models.Model):
     '''
     区块高度
     '''
-    height = models.IntegerField('高度', default=0, db_index=True)
+    height = models.IntegerField('高度', default=0, unique=True)
     total_win_count = models.IntegerField('总消息数量', default=0)
     total_reward = models.DecimalField('总区块奖励', max_digits=30, decimal_places=0, default=0)
 
@@ -52,7 +52,7 @@ class TipsetBlock(models.Model):
     tipset = models.ForeignKey('Tipset', related_name='blocks', on_delete=models.DO_NOTHING, null=True)
     height = models.IntegerField('高度', default=0, db_index=True)
     record_time = models.DateTimeField('产生时间', db_index=True)
-    block_hash = models.CharField('消息hash', max_length=128, null=True)
+    block_hash = models.CharField('消息hash', max_length=128, null=True, unique=True)
     miner_address = models.CharField('矿工id', max_length=128, null=True)
     msg_count = models.IntegerField('消息数量', default=0)
     win_count = models.IntegerField('消息数量', default=0)
@@ -64,13 +64,38 @@ class TipsetBlock(models.Model):
         ordering = ["-create_time", ]
 
 
+class TipsetRewardLedger(models.Model):
+    '''
+    区块奖励累计账本，写入区块时在同一事务内按增量更新
+    '''
+    name = models.CharField('账本名称', max_length=32, unique=True)
+    total_reward = models.DecimalField('累计区块奖励', max_digits=34, decimal_places=0, default=0)
+
+    update_time = models.DateTimeField('修改时间', auto_now=True)
+
+
+class TipsetRewardCheckpoint(models.Model):
+    '''
+    区块奖励账本对账检查点
+    '''
+    max_height = models.IntegerField('对账时最高高度', default=0)
+    ledger_reward = models.DecimalField('账本累计奖励', max_digits=34, decimal_places=0, default=0)
+    sum_reward = models.DecimalField('全表求和奖励', max_digits=34, decimal_places=0, default=0)
+    difference = models.DecimalField('差额', max_digits=34, decimal_places=0, default=0)
+
+    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+
+    class Meta:
+        ordering = ["-create_time", ]
+
+
 class TempTipsetBlock(models.Model):
     '''
     临时区块信息
     '''
     height = models.IntegerField('高度', default=0, db_index=True)
     record_time = models.DateTimeField('产生时间', db_index=True)
-    block_hash = models.CharField('消息hash', max_length=128, null=True)
+    block_hash = models.CharField('消息hash', max_length=128, null=True, unique=True)
     miner_address = models.CharField('矿工id', max_length=128, null=True)
     msg_count = models.IntegerField('消息数量', default=0)
     win_count = models.IntegerField('消息数量', default=0)
@@ -1,15 +1,68 @@
 import json
 import math
+import pickle
 import decimal
 import datetime
+import unittest
 
 from django.test import TestCase
 from django.test.client import Client
 
+from explorer_s_common import cache
 from explorer_s_common.utils import format_return, Validator, format_power, format_price, format_fil, str_2_power
-from calculator.interface import CalculatorBase, TipsetBase, LookupBase
+from explorer_s_activity.utils import ColumnarRows, RowFormatter
+from calculator.interface import CalculatorBase, TipsetBase, LookupBase, GasStatBase, np, LOOKUP_SCHEMA
+from calculator.views import LOOKUP_FORMATTER
 
-from calculator.models import TotalPowerDay
+from calculator.models import TotalPower, TotalPowerDay, Tipset, TipsetBlock, TipsetRewardLedger, GasFeeDay, TempTipsetBlock
+
+
+class FakeFilfox(object):
+    '''
+    模拟filfox的tipset分页接口，从head_height开始倒序，null_heights为空块高度不返回
+    '''
+
+    def __init__(self, head_height, null_heights=()):
+        null_heights = set(null_heights)
+        self.heights = [x for x in range(head_height, -1, -1) if x not in null_heights]
+
+    def get_tipset_list(self, page_size=100, page_index=0):
+        heights = self.heights[page_index * page_size:(page_index + 1) * page_size]
+        return {'tipsets': [{
+            'height': x,
+            'blocks': [{'cid': 'block_%s' % x, 'miner': 'f02614', 'messageCount': 10, 'winCount': 1, 'reward': '1000', 'penalty': '0'}]
+        } for x in heights]}
+
+
+class ShiftingFilfox(FakeFilfox):
+    '''
+    每次请求前都产生新区块的filfox，分页在请求之间不断后移
+    '''
+
+    def get_tipset_list(self, page_size=100, page_index=0):
+        head_height = self.heights[0]
+        self.heights = list(range(head_height + 7, head_height, -1)) + self.heights
+        return super(ShiftingFilfox, self).get_tipset_list(page_size=page_size, page_index=page_index)
+
+
+class FlakyFilfox(FakeFilfox):
+    '''
+    failed_pages中的页每页先失败failures次，failures为None时一直失败
+    '''
+
+    def __init__(self, head_height, failed_pages, failures=None):
+        super(FlakyFilfox, self).__init__(head_height=head_height)
+        self.failed_pages = dict([(x, failures) for x in failed_pages])
+
+    def get_tipset_list(self, page_size=100, page_index=0):
+        if page_index in self.failed_pages:
+            failures = self.failed_pages[page_index]
+            if failures is None:
+                return {}
+            if failures > 0:
+                self.failed_pages[page_index] = failures - 1
+                return {}
+        return super(FlakyFilfox, self).get_tipset_list(page_size=page_size, page_index=page_index)
 
 
 class CalculatorTestCase(TestCase):
@@ -34,6 +87,179 @@ class CalculatorTestCase(TestCase):
         )
         print(result)
 
+    def test_get_day_block_reward(self):
+        for day, current_net_power in [(1, 569), (27, 855), (300, 3000)]:
+            simple_minted = 770000000 if current_net_power > 2.5 * 1024 else 330000000
+            expected = 0
+            for i in range(148888 + 2880 * (day - 1), 148888 + 2880 * day):
+                simple_reward = simple_minted * math.exp(-1.09897764548444e-7 * i) * 1.09897764548444e-7 / 5
+                baseline_reward = (0.1586 * i / 2880 - 0.041) / 2.5
+                expected += decimal.Decimal(simple_reward + baseline_reward) * 5
+
+            result = CalculatorBase().get_day_block_reward(day=day, avg_tipset_blocks=5, current_net_power=current_net_power)
+            self.assertLess(abs(result - expected) / expected, decimal.Decimal('1e-12'))
+
+    def _legacy_accumulate_lookup(self, data, release_days, package_days):
+        '''
+        旧的逐日累计算法，作为单次遍历算法的对照
+        '''
+        base = CalculatorBase()
+        for per in data:
+            if per['day'] > 1:
+                per['today_release'] = per['today_reward'] * decimal.Decimal(0.25) + base.get_today_release(
+                    day=per['day'], data=data, release_days=release_days)
+            if per['day'] > package_days:
+                per['today_release_principal'] = base.get_today_release_principal(
+                    day=per['day'], data=data, package_days=package_days)
+            per['total_pledge'] = base.get_total_pledge(day=per['day'], data=data)
+            per['total_reward'] = base.get_total_reward(day=per['day'], data=data)
+            per['total_release'] = base.get_total_release(day=per['day'], data=data)
+            per['total_release_principal'] = base.get_total_release_principal(day=per['day'], data=data)
+            per['total_already_release'] = per['total_release'] + per['total_release_principal']
+        return data
+
+    def test_accumulate_lookup(self):
+        columns = [
+            'today_release', 'today_release_principal', 'total_pledge', 'total_reward',
+            'total_release', 'total_release_principal', 'total_already_release'
+        ]
+        for days in [2, 181, 541, 1081]:
+            for release_days in [1, 180]:
+                for power_per_day, total_power in [(2, 120), (7, 200), (15, 15)]:
+                    data = []
+                    for i in range(1, days):
+                        today_new_power = power_per_day if i * power_per_day <= total_power else 0
+                        data.append({
+                            'day': i,
+                            'today_reward': decimal.Decimal(min(i * power_per_day, total_power)) * decimal.Decimal('0.0231') / i,
+                            'today_pledge': decimal.Decimal(today_new_power) * decimal.Decimal('6.3104'),
+                            'today_release': 0,
+                            'today_release_principal': 0
+                        })
+                    expected = self._legacy_accumulate_lookup([dict(x) for x in data], release_days, 540)
+                    result = CalculatorBase().accumulate_lookup([dict(x) for x in data], release_days, 540)
+                    for x, y in zip(expected, result):
+                        for key in columns:
+                            self.assertEqual(format_price(x[key], 8), format_price(y[key], 8))
+
+    def test_get_date_simple_reward(self):
+        lookup = LookupBase()
+        for date in [datetime.date(2020, 8, 25), datetime.date(2020, 8, 26), datetime.date(2021, 6, 1), datetime.date(2023, 12, 31)]:
+            start_date = datetime.datetime(date.year, date.month, date.day)
+            if date == lookup.launch_date.date():
+                start_index, end_index = 0, 2160
+            else:
+                start_index = int((start_date - lookup.launch_date).total_seconds() / 30)
+                end_index = start_index + 2880
+            expected = sum([lookup.get_simple_reward(block_num=i) for i in range(start_index, end_index)])
+
+            result = lookup.get_date_simple_reward(date=date)
+            self.assertLess(abs(result - expected) / expected, decimal.Decimal('1e-12'))
+
+    @unittest.skipIf(np is None, 'numpy未安装')
+    def test_project_lookups_by_array(self):
+        self.init_day_total_power()
+
+        params = {
+            'history_lookups': LookupBase().get_history_lookups(must_update_cache=True),
+            'luck_v': decimal.Decimal('0.95'), 'increase_power': decimal.Decimal(10 * math.pow(1024, 5)), 'days': 540,
+            'current_base_fee': decimal.Decimal(100000000), 'avg_create_gas': decimal.Decimal('0.05'),
+            'avg_keep_gas': decimal.Decimal('0.0004')
+        }
+        expected = LookupBase().project_lookups(**params)
+        result = LookupBase().project_lookups_by_array(**params)
+        self.assertEqual(len(expected), len(result))
+        for x, y in zip(expected, result):
+            self.assertEqual(x['date'], y['date'])
+            for key in ['power', 'sum_power', 'reward_by_luck', 'avg_reward', 'miner_release', 'avg_pledge', 'sum_pledge', 'circulating_supply']:
+                self.assertLess(abs(x[key] - y[key]), abs(x[key]) * decimal.Decimal('1e-9') + decimal.Decimal('1e-9'))
+
+    def test_get_history_lookups_incremental(self):
+        self.init_day_total_power()
+        lookup = LookupBase()
+        cache.Cache().set(key=lookup.cache_key_history_state, value={}, time_out=60)
+        lookup.get_history_lookups(must_update_cache=True)
+
+        # 修改中间一天并新增一天，增量计算结果应与全量计算一致
+        obj = TotalPowerDay.objects.filter().order_by('date')[50]
+        obj.luck = decimal.Decimal('0.8')
+        obj.save()
+        last = TotalPowerDay.objects.filter().order_by('-date')[0]
+        TotalPowerDay.objects.create(date=last.date + datetime.timedelta(days=1), power=last.power, increase_power=last.increase_power, luck=1)
+        result = lookup.get_history_lookups(must_update_cache=True)
+
+        cache.Cache().set(key=lookup.cache_key_history_state, value={}, time_out=60)
+        expected = lookup.get_history_lookups(must_update_cache=True)
+        self.assertEqual(len(expected), len(result))
+        for x, y in zip(expected, result):
+            self.assertEqual(x, y)
+
+    def test_columnar_lookups(self):
+        self.init_day_total_power()
+        cache.Cache().set(key=LookupBase().cache_key_history_state, value={}, time_out=60)
+        lookups = LookupBase().get_history_lookups(must_update_cache=True)
+        rows = pickle.loads(pickle.dumps(lookups))
+        self.assertEqual([x[0] for x in rows.schema], [x[0] for x in LOOKUP_SCHEMA])
+        self.assertEqual(len(rows), TotalPowerDay.objects.count())
+        self.assertEqual(rows.to_rows(), lookups.to_rows())
+        self.assertEqual(rows[-1]['date'], TotalPowerDay.objects.filter()[0].date)
+        self.assertEqual(len(rows[:10] + rows[10:]), len(rows))
+
+        # Decimal列按原值保存，字节级算力和attoFIL精度不丢失
+        value = decimal.Decimal('123456789012345678901234567.123456789')
+        rows = pickle.loads(pickle.dumps(ColumnarRows.from_rows([{'power': value}], [('power', 'decimal')])))
+        self.assertEqual(rows[0]['power'], value)
+
+    def test_lookup_formatter(self):
+        self.init_day_total_power()
+        rows = LookupBase().get_history_lookups(must_update_cache=True).to_rows()
+        expected = [dict(per) for per in rows]
+        LOOKUP_FORMATTER.apply(rows)
+        for x, y in zip(expected, rows):
+            self.assertEqual(x['day'] + 1, y['day'])
+            self.assertEqual(x['date'].strftime('%Y-%m-%d'), y['date'])
+            self.assertEqual(format_power(x['sum_power']), y['sum_power_str'])
+            self.assertEqual(format_price(x['avg_reward'], 8), y['avg_reward'])
+            self.assertEqual(x['pledge'], y['pledge'])
+        self.assertEqual(json.loads(''.join(LOOKUP_FORMATTER.iter_json(rows, keys=['date'], chunk_size=7))), [{'date': x['date']} for x in rows])
+
+        # 相等但写法不同的值分别格式化
+        formatter = RowFormatter([('value', 'value', str)])
+        values = [decimal.Decimal('1'), decimal.Decimal('1.00'), 1, 1.0, True, -0.0, 0.0]
+        self.assertEqual(formatter.format_column(values, str), [str(x) for x in values])
+
+    def test_get_lookups_stream(self):
+        self.init_day_total_power()
+        TotalPower.objects.create(record_time=datetime.datetime.now(), base_fee=100000000)
+
+        # 拼起来的流式输出和非流式接口的整个JSON一致
+        for params in [
+            {'luck_v': '0.95', 'increase_power': '10', 'days': 30, 'fields': 'date,avg_reward,power_str'},
+            {'luck_v': '0.95', 'increase_power': '10', 'days': 30},
+        ]:
+            expected = self.client.post('/activity/api/calculator/viewer/get_lookups', data=params).json()
+            response = self.client.post('/activity/api/calculator/viewer/get_lookups_stream', data=params)
+            self.assertEqual(json.loads(b''.join(response.streaming_content).decode()), expected)
+            if params.get('fields'):
+                self.assertEqual(sorted(expected['data'][0].keys()), ['avg_reward', 'date', 'power_str'])
+
+        params = {'current_date': '2020-11-23', 'total_power': 200, 'increase_power_per_day': 14.83}
+        for fields in ['', 'date,today_power,today_reward']:
+            expected = self.client.post('/activity/api/calculator/get_calculate_detail', data=dict(params, fields=fields)).json()
+            response = self.client.post('/activity/api/calculator/get_calculate_detail_stream', data=dict(params, fields=fields))
+            self.assertEqual(json.loads(b''.join(response.streaming_content).decode()), expected)
+
+    def test_get_lookups_segment(self):
+        self.init_day_total_power()
+        TotalPower.objects.create(record_time=datetime.datetime.now(), base_fee=100000000)
+
+        long_lookups = LookupBase().get_lookups(luck_v='0.95', increase_power=decimal.Decimal(10), days=45, must_update_cache=True)
+        short_lookups = LookupBase().get_lookups(luck_v='0.950000001', increase_power=decimal.Decimal(10), days=20)
+        self.assertEqual(len(long_lookups) - len(short_lookups), 25)
+        for x, y in zip(short_lookups, long_lookups):
+            self.assertEqual(x['date'], y['date'])
+            self.assertEqual(x['avg_pledge'], y['avg_pledge'])
+
     def test_calculator(self):
         # result = self.client.post('/activity/api/calculator/sync_total_power_per_hour').json()
         # print(result)
@@ -76,6 +302,37 @@ class CalculatorTestCase(TestCase):
         # result = self.client.post('/activity/admin/calculator/search_logs', data={}).json()
         # print(json.dumps(result['data'], indent=2))
 
+    def test_calculate_sum_batch(self):
+        scenarios = [
+            {'power_per_day': 2, 'total_power': 120, 'init_power': 0, 'luck_v': '0.997', 'increase_power_per_day': 14.83, 'price': 29, 'cost': 350000},
+            {'power_per_day': 5, 'total_power': 120, 'init_power': 0, 'luck_v': '0.997', 'increase_power_per_day': 14.83, 'price': 29, 'cost': 350000},
+            {'power_per_day': 5, 'total_power': 200, 'init_power': 20, 'luck_v': '0.95', 'increase_power_per_day': 10, 'price': 35, 'cost': 500000}
+        ]
+        result = self.client.post('/activity/api/calculator/get_calculate_sum_batch', data={
+            'current_date': '2020-11-23', 'scenarios': json.dumps(scenarios)
+        }).json()
+        self.assertEqual(len(result['data']), len(scenarios))
+        # 每个场景的结果和单独计算一致
+        for scenario, data in zip(scenarios, result['data']):
+            params = dict(scenario, current_date='2020-11-23')
+            expected = self.client.post('/activity/api/calculator/get_calculate_sum', data=params).json()
+            self.assertEqual(data, expected['data'])
+
+        result = self.client.post('/activity/api/calculator/get_calculate_sum_batch', data={
+            'scenarios': json.dumps(scenarios * 17)
+        }).json()
+        self.assertEqual(result['code'], 14002)
+        result = self.client.post('/activity/api/calculator/get_calculate_sum_batch', data={
+            'scenarios': json.dumps({'power_per_day': 2})
+        }).json()
+        self.assertEqual(result['code'], 14001)
+        # 数值不合法或除数为0的场景
+        for scenario in [{'power_per_day': 'abc'}, {'total_power': 0}, {'cost': '0'}, {'luck_v': None}, {'price': 'NaN'}, {'increase_power_per_day': [1]}]:
+            result = self.client.post('/activity/api/calculator/get_calculate_sum_batch', data={
+                'scenarios': json.dumps([scenarios[0], scenario])
+            }).json()
+            self.assertEqual(result['code'], 14001)
+
     def test_tipset(self):
 
         blocks = [{
@@ -94,6 +351,116 @@ class CalculatorTestCase(TestCase):
         result = TipsetBase().sync_tipset(date='2020-11-13')
         print(result)
 
+    def test_backfill_tipset(self):
+        null_heights = range(17000, 17100, 3)
+        sdk = FakeFilfox(head_height=25000, null_heights=null_heights)
+
+        for height in [25000, 19440, 17050, 16560]:
+            page_index = TipsetBase().find_tipset_page(height=height, sdk=sdk)
+            tipsets = TipsetBase().get_tipset_page(page_index=page_index, sdk=sdk)
+            self.assertGreaterEqual(tipsets[0]['height'], height)
+            self.assertLessEqual(tipsets[-1]['height'], height)
+
+        # 取页失败时重试，一直失败时定位不到分页，不能当作高度更低的页
+        page_index = TipsetBase().find_tipset_page(height=19440, sdk=FakeFilfox(head_height=25000))
+        self.assertEqual(TipsetBase().find_tipset_page(height=19440, sdk=FlakyFilfox(25000, range(100), failures=2)), page_index)
+        self.assertIsNone(TipsetBase().find_tipset_page(height=19440, sdk=FlakyFilfox(25000, [page_index])))
+        result = TipsetBase().backfill_tipset(date='2020-09-01', max_workers=3, rate=100, sdk=FlakyFilfox(25000, [0]))
+        self.assertFalse(result['data']['finished'])
+        self.assertEqual(Tipset.objects.count(), 0)
+
+        # 2020-09-01 对应高度 16560 ~ 19440，先从断点18000继续，再整天重跑
+        cache.Cache().set(key='calculator_tipset_backfill_2020-09-01', value=18000, time_out=60)
+        result = TipsetBase().backfill_tipset(date='2020-09-01', max_workers=3, rate=100, sdk=sdk)
+        self.assertTrue(result['data']['finished'])
+        self.assertEqual(Tipset.objects.count(), 18000 - 16560)
+
+        cache.Cache().set(key='calculator_tipset_backfill_2020-09-01', value=None, time_out=60)
+        TipsetBase().backfill_tipset(date='2020-09-01', max_workers=3, rate=100, sdk=sdk)
+        self.assertEqual(Tipset.objects.count(), 19440 - 16560 + 1)
+        self.assertEqual(TipsetBlock.objects.count(), 19440 - 16560 + 1 - len(null_heights))
+
+        # 分页移动时不能把有区块的高度写成空块
+        Tipset.objects.all().delete()
+        TipsetBlock.objects.all().delete()
+        cache.Cache().set(key='calculator_tipset_backfill_2020-09-01', value=None, time_out=60)
+        sdk = ShiftingFilfox(head_height=25000, null_heights=null_heights)
+        result = TipsetBase().backfill_tipset(date='2020-09-01', max_workers=3, rate=100, sdk=sdk)
+        self.assertTrue(result['data']['finished'])
+        self.assertEqual(Tipset.objects.count(), 19440 - 16560 + 1)
+        self.assertEqual(TipsetBlock.objects.count(), 19440 - 16560 + 1 - len(null_heights))
+
+    def test_get_luck_v(self):
+        record_time = datetime.datetime(2020, 9, 1, 1, 0, 0)
+        Tipset.objects.bulk_create([
+            Tipset(height=1, total_win_count=6, record_time=record_time),
+            Tipset(height=2, total_win_count=0, record_time=record_time),
+            Tipset(height=3, total_win_count=4, record_time=record_time),
+        ])
+        self.assertEqual(LookupBase().get_luck_v(date=datetime.datetime(2020, 9, 1)), 1)
+        Tipset.objects.filter(height=1).update(total_win_count=3)
+        self.assertEqual(LookupBase().get_luck_v(date=datetime.datetime(2020, 9, 1)), decimal.Decimal('0.7'))
+        self.assertEqual(LookupBase().get_luck_v(date=datetime.datetime(2020, 9, 2)), 1)
+
+        cache.Cache().set(key=LookupBase().cache_key_rolling_luck, value=None, time_out=60)
+        LookupBase().update_rolling_luck(height_win_counts={}, min_height=0)
+        state = LookupBase().update_rolling_luck(height_win_counts={10: 4, 11: 0, 12: 2, 13: 3}, min_height=11)
+        self.assertEqual(state['height_count'], 2)
+        self.assertEqual(LookupBase().get_luck_v(), decimal.Decimal('0.5'))
+
+        # 缓存失效时直接汇总临时区块，同样只统计出了块的高度
+        TempTipsetBlock.objects.bulk_create([
+            TempTipsetBlock(height=height, win_count=win_count, record_time=record_time)
+            for height, win_count in [(20, 3), (20, 2), (21, 0), (22, 0), (23, 5)]
+        ])
+        cache.Cache().set(key=LookupBase().cache_key_rolling_luck, value=None, time_out=60)
+        self.assertEqual(LookupBase().get_luck_v(), decimal.Decimal('1'))
+        TempTipsetBlock.objects.filter(height=23).update(win_count=1)
+        self.assertEqual(LookupBase().get_luck_v(), decimal.Decimal('0.6'))
+        LookupBase().update_rolling_luck(height_win_counts={}, min_height=0)
+        self.assertEqual(LookupBase().get_luck_v(), decimal.Decimal('0.6'))
+
+    def test_total_rewards_ledger(self):
+        blocks = [{'cid': 'block_a', 'miner': 'f01', 'messageCount': 1, 'winCount': 1, 'reward': '100', 'penalty': '0'}]
+        TipsetBase().add_tipset_2(height=100, blocks=blocks)
+        self.assertEqual(TipsetBase().get_total_rewards(), 100)
+
+        TipsetBase().add_tipset_2(height=101, blocks=[dict(blocks[0], cid='block_b', reward='50')])
+        TipsetBase().add_tipsets_bulk(tipsets=[(100, [dict(blocks[0], reward='80')]), (102, [])])
+        self.assertEqual(TipsetBase().get_total_rewards(), 130)
+
+        TipsetRewardLedger.objects.update(total_reward=0)
+        result = TipsetBase().reconcile_total_rewards()
+        self.assertEqual(result['data']['difference'], 130)
+        self.assertEqual(TipsetBase().get_total_rewards(), 130)
+
+    def test_gas_stat(self):
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        # 缺少一天的数据不影响均值
+        for i in [1, 2, 4]:
+            date = today - datetime.timedelta(days=i)
+            GasFeeDay.objects.create(date=date, method='PreCommitSector', count=10, total_fee=10 * i * 10**18)
+            GasFeeDay.objects.create(date=date, method='ProveCommitSector', count=5, total_fee=5 * 10**18)
+        self.assertAlmostEqual(float(GasStatBase().get_avg_create_gas_by_day()), (7 / 3 + 1) * 32)
+
+        for i in range(8):
+            TotalPowerDay.objects.create(
+                date=today - datetime.timedelta(days=i), power=(i + 1) * 1024**4, submit_windowed_po_st_total_gas=i + 1
+            )
+        self.assertAlmostEqual(float(GasStatBase().get_avg_keep_gas_by_day()), 1)
+
+        # 和以前逐条计算的结果完全一致
+        TotalPowerDay.objects.all().delete()
+        for i in range(7):
+            TotalPowerDay.objects.create(
+                date=today - datetime.timedelta(days=i), power=(1031 + i * 977) * 1024**5 + 12345,
+                submit_windowed_po_st_total_gas=decimal.Decimal('1234.567891') * (i + 3)
+            )
+        expected = 0
+        for per in TotalPowerDay.objects.filter()[:7]:
+            expected += decimal.Decimal(per.submit_windowed_po_st_total_gas / (per.power / decimal.Decimal(1024**4)))
+        self.assertEqual(GasStatBase().get_avg_keep_gas_by_day(), decimal.Decimal(expected / 7))
+
     def test_sync_total_power_per_hour(self):
         result = self.client.post('/activity/api/calculator/sync_total_power_per_hour').json()
         print(result)
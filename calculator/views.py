@@ -5,17 +5,39 @@ import decimal
 import datetime
 from collections import Iterable
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 
 from explorer_s_common.decorator import common_ajax_response
 from explorer_s_common.utils import format_return, format_price, format_power, str_2_power, format_coin_to_str, _d
 from explorer_s_common.page import Page
-from explorer_s_common import inner_server, cache
+from explorer_s_common import debug, inner_server, cache
 from explorer_s_common.third.filscout_sdk import FilscoutBase
 from explorer_s_common.third.filfox_sdk import FilfoxBase
 
 from explorer_s_activity import consts
-from calculator.interface import CalculatorBase, LookupBase, TipsetBase
+from explorer_s_activity.utils import RowFormatter
+from calculator.interface import CalculatorBase, LookupBase, TipsetBase, GasStatBase, LOOKUP_DETAIL_FORMATTER
+
+
+# 对照接口输出的字段格式
+LOOKUP_FORMATTER = RowFormatter(
+    [
+        ('day', 'day', lambda x: x + 1),
+        ('date', 'date', lambda x: x.strftime('%Y-%m-%d')),
+        ('base_fee_str', 'base_fee', lambda x: format_coin_to_str(x) + 'FIL'),
+        ('circulating_supply_str', 'circulating_supply', lambda x: format_coin_to_str(x) + 'FIL'),
+    ] +
+    [(x + '_str', x, format_power) for x in (
+        'power', 'limit_power', 'sum_power', 'kpi_power', 'increase_power', 'packing_power'
+    )] +
+    [(x, x, lambda value: format_price(value, 8)) for x in (
+        'kpi_time', 'sum_baseline_reward', 'luck_v', 'baseline_reward', 'simple_reward', 'reward', 'reward_by_luck',
+        'avg_reward', 'avg_pledge'
+    )]
+)
+# 批量矿机产出计算一次最多的场景数
+MAX_BATCH_SCENARIOS = 50
 
 
 @common_ajax_response
@@ -33,8 +55,9 @@ def get_calculate_info(request):
     keep_cost_gas_per_t = gas_stat['submit_windowed_po_st'] / (_d(overview['total_power']) / _d(math.pow(1024, 4)))
 
     # gas相关
-    gas_info_32 = inner_server.get_gas_cost_stat({'sector_type': '0'}).get('data', {})
-    gas_info_64 = inner_server.get_gas_cost_stat({'sector_type': '1'}).get('data', {})
+    gas_info = GasStatBase().get_gas_cost_info(must_update_cache=must_update_cache)
+    gas_info_32 = gas_info['gas_info_32']
+    gas_info_64 = gas_info['gas_info_64']
     info = {
         'total_power_str': overview.get('total_power_str'),
         'avg_reward': overview.get('avg_reward'),
@@ -60,31 +83,10 @@ def get_calculate_info(request):
     return format_return(0, data=info)
 
 
-@common_ajax_response
-def get_calculate_sum(request):
+def _get_calculate_sum_result(data, cost, price, rate, total_power, init_power, power_per_day, is_use_gas=False):
     '''
-    矿机产出计算
+    从对照表汇总平衡日、封满日、预质押量
     '''
-    power_per_day = decimal.Decimal(request.POST.get('power_per_day', '2'))
-    total_power = decimal.Decimal(request.POST.get('total_power', '120'))
-    init_power = decimal.Decimal(request.POST.get('init_power', '0'))
-    cost = decimal.Decimal(request.POST.get('cost', '1'))
-    price = decimal.Decimal(request.POST.get('price', '1'))
-    current_date = request.POST.get('current_date')
-    current_date = datetime.datetime.strptime(current_date, '%Y-%m-%d') if current_date else datetime.datetime.now()
-    increase_power_per_day = float(request.POST.get('increase_power_per_day', '10'))
-    search_type = request.POST.get('search_type', '0')
-    luck_v = request.POST.get('luck_v', '0.997')
-    is_merge = json.loads(request.POST.get('is_merge', '1'))
-    is_use_gas = json.loads(request.POST.get('is_use_gas', '0'))
-
-    data = CalculatorBase().generate_lookup(
-        current_date=current_date, power_per_day=power_per_day, total_power=total_power,
-        increase_power_per_day=increase_power_per_day, init_power=init_power, luck_v=luck_v,
-        is_merge=is_merge
-    )
-    rate = CalculatorBase().get_usd_rate()
-    overview = CalculatorBase().get_fil_overview()
     win_day = 0
 
     records = []
@@ -118,6 +120,41 @@ def get_calculate_sum(request):
     # 排序
     sorted_records = sorted(records, key=lambda x: x['day'])
 
+    return {
+        'records': sorted_records, 'win_day': win_day, 'full_day': full_day,
+        'pre_pledge': format_price(pre_pledge, 4)
+    }
+
+
+@common_ajax_response
+def get_calculate_sum(request):
+    '''
+    矿机产出计算
+    '''
+    power_per_day = decimal.Decimal(request.POST.get('power_per_day', '2'))
+    total_power = decimal.Decimal(request.POST.get('total_power', '120'))
+    init_power = decimal.Decimal(request.POST.get('init_power', '0'))
+    cost = decimal.Decimal(request.POST.get('cost', '1'))
+    price = decimal.Decimal(request.POST.get('price', '1'))
+    current_date = request.POST.get('current_date')
+    current_date = datetime.datetime.strptime(current_date, '%Y-%m-%d') if current_date else datetime.datetime.now()
+    increase_power_per_day = float(request.POST.get('increase_power_per_day', '10'))
+    search_type = request.POST.get('search_type', '0')
+    luck_v = request.POST.get('luck_v', '0.997')
+    is_merge = json.loads(request.POST.get('is_merge', '1'))
+    is_use_gas = json.loads(request.POST.get('is_use_gas', '0'))
+
+    data = CalculatorBase().generate_lookup(
+        current_date=current_date, power_per_day=power_per_day, total_power=total_power,
+        increase_power_per_day=increase_power_per_day, init_power=init_power, luck_v=luck_v,
+        is_merge=is_merge
+    )
+    rate = CalculatorBase().get_usd_rate()
+    result = _get_calculate_sum_result(
+        data=data, cost=cost, price=price, rate=rate, total_power=total_power, init_power=init_power,
+        power_per_day=power_per_day, is_use_gas=is_use_gas
+    )
+
     # 记录日志
     user_id = request.POST.get('user_id')
     if user_id:
@@ -127,17 +164,137 @@ def get_calculate_sum(request):
             increase=increase_power_per_day
         )
 
-    return format_return(0, data={
-        'records': sorted_records, 'win_day': win_day, 'full_day': full_day,
-        'pre_pledge': format_price(pre_pledge, 4)
-    })
+    return format_return(0, data=result)
+
+
+def _parse_scenario(scenario):
+    '''
+    解析批量计算的一个场景，默认值同get_calculate_sum
+    数值不合法时抛出decimal.InvalidOperation/ValueError/TypeError，作为除数的每日封装算力、总算力、成本必须大于0
+    '''
+    def _get_decimal(key, default):
+        value = decimal.Decimal(str(scenario.get(key, default)))
+        if not value.is_finite():
+            raise ValueError('%s must be finite' % key)
+        return value
+
+    result = {
+        'power_per_day': _get_decimal('power_per_day', '2'),
+        'total_power': _get_decimal('total_power', '120'),
+        'init_power': _get_decimal('init_power', '0'),
+        'cost': _get_decimal('cost', '1'),
+        'price': _get_decimal('price', '1'),
+        'increase_power_per_day': float(_get_decimal('increase_power_per_day', '10')),
+        'luck_v': str(_get_decimal('luck_v', '0.997'))
+    }
+    for key in ('power_per_day', 'total_power', 'cost'):
+        if result[key] <= 0:
+            raise ValueError('%s must be positive' % key)
+    return result
 
 
 @common_ajax_response
-def get_calculate_detail(request):
+def get_calculate_sum_batch(request):
     '''
-    获取计算汇总详情
+    批量矿机产出计算
+    scenarios: json列表，最多50个场景，每项可包含power_per_day、total_power、init_power、luck_v、increase_power_per_day、price、cost
+    所有场景共享币价汇率、gas、全网概览以及相同幸运值和算力增速的对照
     '''
+    try:
+        scenarios = json.loads(request.POST.get('scenarios', '[]'))
+    except ValueError:
+        return format_return(14001)
+    if not isinstance(scenarios, list) or not all([isinstance(x, dict) for x in scenarios]):
+        return format_return(14001)
+    if len(scenarios) > MAX_BATCH_SCENARIOS:
+        return format_return(14002)
+    # 先校验全部场景，任一场景参数错误都不开始计算
+    try:
+        scenarios = [_parse_scenario(x) for x in scenarios]
+    except (decimal.InvalidOperation, ValueError, TypeError):
+        return format_return(14001)
+    current_date = request.POST.get('current_date')
+    current_date = datetime.datetime.strptime(current_date, '%Y-%m-%d') if current_date else datetime.datetime.now()
+    is_merge = json.loads(request.POST.get('is_merge', '1'))
+    is_use_gas = json.loads(request.POST.get('is_use_gas', '0'))
+
+    rate = CalculatorBase().get_usd_rate()
+    context = CalculatorBase().get_lookup_context()
+
+    results = []
+    for scenario in scenarios:
+        data = CalculatorBase().generate_lookup(
+            current_date=current_date, power_per_day=scenario['power_per_day'], total_power=scenario['total_power'],
+            increase_power_per_day=scenario['increase_power_per_day'], init_power=scenario['init_power'],
+            luck_v=scenario['luck_v'], is_merge=is_merge, context=context
+        )
+        results.append(_get_calculate_sum_result(
+            data=data, cost=scenario['cost'], price=scenario['price'], rate=rate, total_power=scenario['total_power'],
+            init_power=scenario['init_power'], power_per_day=scenario['power_per_day'], is_use_gas=is_use_gas
+        ))
+
+    return format_return(0, data=results)
+
+
+def _get_fields(request):
+    '''
+    fields=date,avg_reward,... 只返回指定字段
+    '''
+    return [x.strip() for x in request.POST.get('fields', '').split(',') if x.strip()] or None
+
+
+def _project_fields(rows, fields):
+    if not fields:
+        return rows
+    return [dict([(key, per[key]) for key in fields if key in per]) for per in rows]
+
+
+def _iter_rows(rows):
+    '''
+    逐行取出列表中的行，取出后释放引用，输出过的行不再占内存；ColumnarRows等直接迭代
+    '''
+    if not isinstance(rows, list):
+        for per in rows:
+            yield per
+        return
+    rows.reverse()
+    while rows:
+        yield rows.pop()
+
+
+def _get_stream_response(get_rows, formatter, fields=None):
+    '''
+    分块输出format_return(0, data=rows)
+    外层只编码一次，rows按段格式化、编码后输出，整个过程共用一个encoder
+    get_rows: 取行数据的函数，开始输出前出错时返回和非流式接口一样的错误JSON
+    开始输出后出错时闭合已输出的数组，并在外层加上error字段，保证仍是完整的JSON
+    '''
+    encoder = DjangoJSONEncoder()
+    try:
+        rows = get_rows()
+    except Exception as e:
+        debug.get_debug_detail(e)
+        return HttpResponse(encoder.encode(format_return(14003)), content_type='application/json')
+
+    envelope = format_return(0)
+    head = '{' + ''.join([
+        '%s: %s, ' % (encoder.encode(key), encoder.encode(value)) for key, value in envelope.items() if key != 'data'
+    ]) + '"data": '
+
+    def _iter():
+        yield head
+        try:
+            for chunk in formatter.iter_json(_iter_rows(rows), keys=fields, is_format=True, encoder=encoder):
+                yield chunk
+            yield '}'
+        except Exception as e:
+            debug.get_debug_detail(e)
+            yield '], "error": %s}' % encoder.encode(format_return(14003))
+
+    return StreamingHttpResponse(_iter(), content_type='application/json')
+
+
+def _get_calculate_detail_data(request, is_format=True):
     power_per_day = decimal.Decimal(request.POST.get('power_per_day', '2'))
     total_power = decimal.Decimal(request.POST.get('total_power', '120'))
     init_power = decimal.Decimal(request.POST.get('init_power', '0'))
@@ -151,13 +308,29 @@ def get_calculate_detail(request):
     luck_v = request.POST.get('luck_v', '0.997')
     is_merge = json.loads(request.POST.get('is_merge', '1'))
 
-    data = CalculatorBase().generate_lookup(
+    return CalculatorBase().generate_lookup(
         current_date=current_date, power_per_day=power_per_day, total_power=total_power,
         increase_power_per_day=increase_power_per_day, init_power=init_power, luck_v=luck_v,
-        is_merge=is_merge
+        is_merge=is_merge, is_format=is_format
     )
 
-    return format_return(0, data=data)
+
+@common_ajax_response
+def get_calculate_detail(request):
+    '''
+    获取计算汇总详情
+    '''
+    data = _get_calculate_detail_data(request)
+    return format_return(0, data=_project_fields(data, _get_fields(request)))
+
+
+def get_calculate_detail_stream(request):
+    '''
+    获取计算汇总详情，分块输出，参数同get_calculate_detail
+    '''
+    return _get_stream_response(
+        lambda: _get_calculate_detail_data(request, is_format=False), LOOKUP_DETAIL_FORMATTER, fields=_get_fields(request)
+    )
 
 
 def _get_lookup(total_power, avg_reward):
@@ -174,16 +347,8 @@ def _get_lookup(total_power, avg_reward):
             'total_release': 0
         })
 
-    for per in data:
-        # ======== 当日释放奖励
-        if per['day'] > 1:
-            per['today_release'] = per['today_reward'] * decimal.Decimal(0.25) + CalculatorBase().get_today_release(
-                day=per['day'], data=data, release_days=release_days)
-
-        # ======== 累计释放
-        per['total_release'] = CalculatorBase().get_total_release(day=per['day'], data=data)
-
-    return data
+    # ======== 当日释放奖励、累计释放
+    return CalculatorBase().accumulate_lookup(data=data, release_days=release_days)
 
 
 @common_ajax_response
@@ -249,11 +414,7 @@ def get_cost_calculate_sum(request):
     )
 
 
-@common_ajax_response
-def get_lookups(request):
-    '''
-    获取对照信息
-    '''
+def _get_lookups_data(request):
     luck_v = request.POST.get('luck_v', '')
     increase_power = request.POST.get('increase_power', '')
     days = int(request.POST.get('days', 540))
@@ -262,32 +423,25 @@ def get_lookups(request):
     increase_power = decimal.Decimal(increase_power) if increase_power else None
     must_update_cache = json.loads(request.POST.get('must_update_cache', '0'))
 
-    lookups = LookupBase().get_lookups(
+    return LookupBase().get_lookups(
         cache_key, luck_v=luck_v, increase_power=increase_power, days=days, must_update_cache=must_update_cache
     )
 
-    for per in lookups:
-        per['day'] = per['day'] + 1
-        per['date'] = per['date'].strftime('%Y-%m-%d')
-        per['power_str'] = format_power(per['power'])
-        per['limit_power_str'] = format_power(per['limit_power'])
-        per['sum_power_str'] = format_power(per['sum_power'])
-        per['kpi_time'] = format_price(per['kpi_time'], 8)
-        per['kpi_power_str'] = format_power(per['kpi_power'])
-        per['sum_baseline_reward'] = format_price(per['sum_baseline_reward'], 8)
-        per['luck_v'] = format_price(per['luck_v'], 8)
-        per['increase_power_str'] = format_power(per['increase_power'])
-        per['packing_power_str'] = format_power(per['packing_power'])
-        per['baseline_reward'] = format_price(per['baseline_reward'], 8)
-        per['simple_reward'] = format_price(per['simple_reward'], 8)
-        per['reward'] = format_price(per['reward'], 8)
-        per['reward_by_luck'] = format_price(per['reward_by_luck'], 8)
-        per['avg_reward'] = format_price(per['avg_reward'], 8)
-        per['base_fee_str'] = format_coin_to_str(per['base_fee']) + 'FIL'
-        per['circulating_supply_str'] = format_coin_to_str(per['circulating_supply']) + 'FIL'
-        per['avg_pledge'] = format_price(per['avg_pledge'], 8)
-
-    return format_return(0, data=lookups)
+
+@common_ajax_response
+def get_lookups(request):
+    '''
+    获取对照信息
+    '''
+    lookups = LOOKUP_FORMATTER.apply(_get_lookups_data(request).to_rows())
+    return format_return(0, data=_project_fields(lookups, _get_fields(request)))
+
+
+def get_lookups_stream(request):
+    '''
+    获取对照信息，分块输出，参数同get_lookups
+    '''
+    return _get_stream_response(lambda: _get_lookups_data(request), LOOKUP_FORMATTER, fields=_get_fields(request))
 
 
 @common_ajax_response
@@ -315,8 +469,8 @@ def get_calculate_sum_v2(request):
     '''计算版本2'''
 
     rate = _d(CalculatorBase().get_usd_rate())
-    overview = CalculatorBase().get_fil_overview()
-    gas_stat = CalculatorBase().get_gas_stat()
+    context = CalculatorBase().get_lookup_context()
+    overview = context['overview']
 
     price = _d(overview.get('price'))  # fil单价
     base_cost = _d(4399)
@@ -343,9 +497,10 @@ def get_calculate_sum_v2(request):
     now = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     _offset_days = (current_date - now).days
     avg_reward_lookups = LookupBase().get_lookups(cache_key, luck_v=luck_v, increase_power=increase_power_per_day,
-                                                  days=541 + _offset_days,
-                                                  must_update_cache=True if _offset_days > 0 else False)
-    avg_reward_lookups_dict = dict([(x['date'].strftime('%Y-%m-%d'), x['avg_reward']) for x in avg_reward_lookups])
+                                                  days=541 + _offset_days)
+    avg_reward_lookups_dict = dict(zip(
+        [x.strftime('%Y-%m-%d') for x in avg_reward_lookups.column('date')], avg_reward_lookups.column('avg_reward')
+    ))
     avg_reward = avg_reward_lookups_dict.get(current_date.strftime('%Y-%m-%d'),
                                              _d(overview.get('avg_reward')))  # 当前平均奖励/T
     if current_date.strftime('%Y-%m-%d') == datetime.datetime.now().strftime('%Y-%m-%d'):
@@ -362,7 +517,7 @@ def get_calculate_sum_v2(request):
     data = CalculatorBase().generate_lookup(
         current_date=current_date, power_per_day=power_per_day, total_power=total_power,
         increase_power_per_day=increase_power_per_day, init_power=init_power, luck_v=luck_v,
-        is_merge=is_merge, direct_avg_reward_dict=direct_avg_reward_dict
+        is_merge=is_merge, direct_avg_reward_dict=direct_avg_reward_dict, context=context
     )
     # 平衡日
     win_day = 0
@@ -383,7 +538,7 @@ def get_calculate_sum_v2(request):
     base_data = CalculatorBase().generate_lookup(
         current_date=current_date, power_per_day=power_per_day, total_power=total_power,
         increase_power_per_day=increase_power_per_day, init_power=init_power, luck_v=luck_v,
-        is_merge=is_merge, direct_avg_reward_dict=direct_avg_reward_dict
+        is_merge=is_merge, direct_avg_reward_dict=direct_avg_reward_dict, context=context
     )
 
     # 平衡日
@@ -525,6 +680,18 @@ def sync_tipset(request):
     return TipsetBase().sync_tipset_2(date=date)
 
 
+@common_ajax_response
+def backfill_tipset(request):
+    '''
+    回填指定日期范围的tipset，中断后再次调用会从断点继续
+    '''
+    start_date = request.POST.get('start_date')
+    end_date = request.POST.get('end_date') or start_date
+    max_workers = min(int(request.POST.get('max_workers', 4)), 16)
+    rate = min(float(request.POST.get('rate', 2)), 10)
+    return TipsetBase().backfill_tipsets(start_date=start_date, end_date=end_date, max_workers=max_workers, rate=rate)
+
+
 @common_ajax_response
 def sync_temp_tipset(request):
     '''
@@ -533,6 +700,14 @@ def sync_temp_tipset(request):
     return TipsetBase().sync_temp_tipset()
 
 
+@common_ajax_response
+def reconcile_total_rewards(request):
+    '''
+    每天核对一次区块奖励累计账本并记录检查点
+    '''
+    return TipsetBase().reconcile_total_rewards()
+
+
 @common_ajax_response
 def sync_gas_fee(request):
     '''
@@ -1,5 +1,7 @@
 import time
 import math
+import uuid
+import threading
 import json
 import logging
 import decimal
@@ -7,7 +9,7 @@ import requests
 import datetime
 from lxml import etree
 
-from django.db import transaction
+from django.db import transaction, connection
 from django.db.models import Avg, Q, F, Sum, Count
 
 from explorer_s_common import debug, consts, cache, raw_sql, inner_server
@@ -21,11 +23,16 @@ from explorer_s_common.third.bbhe_sdk import BbheBase
 from explorer_s_common.third.fam_sdk import FamBase
 
 from explorer_s_activity.consts import ERROR_DICT
-from dashboard.models import PoolMiner, PoolMinerDay
+from explorer_s_activity.utils import fetch_concurrently
+from dashboard.models import PoolMiner, PoolMinerDay, SyncLock
 
 
 class DashboardBase(object):
 
+    def __init__(self):
+        # 后台同步矿池矿工的锁
+        self.lock_name_pool_miner = 'dashboard_pool_miner_sync_lock'
+
     @cache_required(cache_key='dashboard_overview', expire=12 * 60 * 60)
     def get_overview(self, must_update_cache=False):
         from calculator.interface import TipsetBase
@@ -80,18 +87,100 @@ class DashboardBase(object):
         return data
 
     @cache_required(cache_key='dashboard_pool_miner_info', expire=12 * 60 * 60)
-    def get_pool_overview(self, must_update_cache=False):
+    def get_pool_overview(self, must_update_cache=False, is_refresh=True):
+        '''
+        矿池概况，取数据库中最近一次同步的矿工数据
+        is_refresh: 缓存失效时在后台刷新矿工数据，刷新完成后再更新缓存
+        '''
+        if is_refresh:
+            self.start_sync_pool_miner_info()
+
+        result = PoolMiner.objects.aggregate(
+            miners_count=Count('id'), active_miners_count=Count('id', filter=Q(power__gt=0)),
+            total_power=Sum('power'), total_reward=Sum('total_reward'), reward=Sum('reward'),
+            increase_power=Sum('increase_power'), increase_power_offset=Sum('increase_power_offset'),
+            avg_reward=Avg('avg_reward'), total_block_count=Sum('total_block_count'), block_count=Sum('block_count'),
+            total_win_count=Sum('total_win_count')
+        )
+        for key in result:
+            result[key] = result[key] or 0
+
+        return {
+            'miners_count': result['miners_count'],
+            'active_miners_count': result['active_miners_count'],
+            'total_power': format_power(result['total_power']),
+            'total_power_v': result['total_power'],
+            'total_reward': result['total_reward'],
+            'reward': result['reward'],
+            'increase_power': format_power(result['increase_power']),
+            'increase_power_v': result['increase_power'],
+            'increase_power_offset': format_power(result['increase_power_offset']),
+            'increase_power_offset_v': result['increase_power_offset'],
+            'avg_reward': format_price(result['avg_reward'], 4),
+            'total_block_count': result['total_block_count'],
+            'block_count': result['block_count'],
+            'total_win_count': result['total_win_count']
+        }
+
+    def acquire_lock(self, name, timeout=10 * 60):
+        '''
+        获取同步锁，成功返回释放用的token，已被占用返回None
+        锁行只创建一次，抢锁是一条带条件的UPDATE，多个进程同时抢只有一个能更新成功
+        持有者超过timeout秒没有释放时锁自动过期
+        '''
+        now = datetime.datetime.now()
+        SyncLock.objects.bulk_create([SyncLock(name=name, expire_time=now)], ignore_conflicts=True)
+        token = uuid.uuid4().hex
+        count = SyncLock.objects.filter(name=name, expire_time__lte=now).update(
+            token=token, expire_time=now + datetime.timedelta(seconds=timeout), update_time=now
+        )
+        return token if count else None
+
+    def release_lock(self, name, token):
+        '''
+        释放同步锁，锁已过期被别人拿到时不释放
+        '''
+        now = datetime.datetime.now()
+        return SyncLock.objects.filter(name=name, token=token).update(token=None, expire_time=now, update_time=now)
 
-        self.sync_pool_miners()
+    def start_sync_pool_miner_info(self):
+        '''
+        在后台线程同步矿池矿工数据，同一时间只有一个同步在运行
+        '''
+        token = self.acquire_lock(name=self.lock_name_pool_miner)
+        if not token:
+            return False
+
+        def _sync():
+            try:
+                self.sync_pool_miner_info()
+            except Exception as e:
+                debug.get_debug_detail(e)
+            finally:
+                self.release_lock(name=self.lock_name_pool_miner, token=token)
+                # 线程里的数据库连接不会被请求结束时回收
+                connection.close()
+
+        threading.Thread(target=_sync, daemon=True).start()
+        return True
+
+    def sync_pool_miner_info(self, max_workers=8):
+        '''
+        同步矿池矿工数据: 并发获取每个矿工的信息，一次bulk_update写入，然后刷新矿池概况缓存
+        '''
+        member_result = self.sync_pool_miners()
 
-        # 先同步数据
-        for miner_address in [x.miner_address for x in PoolMiner.objects.all()]:
+        miners = list(PoolMiner.objects.all())
+        results = fetch_concurrently(
+            lambda miner_no: inner_server.get_miner_by_no({'miner_no': miner_no}),
+            [{'miner_no': x.miner_address} for x in miners], max_workers=max_workers
+        )
 
-            result = inner_server.get_miner_by_no({'miner_no': miner_address})
+        now = datetime.datetime.now()
+        update_miners = []
+        for miner, result in zip(miners, results):
             if not result or not result['data']:
                 continue
-
-            miner, created = PoolMiner.objects.get_or_create(miner_address=miner_address)
             miner.power = result['data']['power']
             miner.increase_power = result['data']['increase_power_24']
             miner.increase_power_offset = result['data']['increase_power_offset_24']
@@ -105,49 +194,18 @@ class DashboardBase(object):
             miner.block_count = result['data']['block_count']
             miner.ip = ''
             miner.area = ''
-            miner.save()
-
-        miners_count = 0
-        active_miners_count = 0
-        total_power = 0
-        total_reward = 0
-        reward = 0
-        increase_power = 0
-        increase_power_offset = 0
-        avg_reward = 0
-        total_block_count = 0
-        block_count = 0
-        total_win_count = 0
-        for miner in PoolMiner.objects.all():
-            miners_count += 1
-            if miner.power > 0:
-                active_miners_count += 1
-            total_power += miner.power
-            total_reward += miner.total_reward
-            increase_power += miner.increase_power
-            increase_power_offset += miner.increase_power_offset
-            avg_reward += miner.avg_reward
-            total_block_count += miner.total_block_count
-            total_win_count += miner.total_win_count
-            reward += miner.reward
-            block_count += miner.block_count
-
-        return {
-            'miners_count': miners_count,
-            'active_miners_count': active_miners_count,
-            'total_power': format_power(total_power),
-            'total_power_v': total_power,
-            'total_reward': total_reward,
-            'reward': reward,
-            'increase_power': format_power(increase_power),
-            'increase_power_v': increase_power,
-            'increase_power_offset': format_power(increase_power_offset),
-            'increase_power_offset_v': increase_power_offset,
-            'avg_reward': format_price(avg_reward / miners_count, 4),
-            'total_block_count': total_block_count,
-            'block_count': block_count,
-            'total_win_count': total_win_count
-        }
+            # bulk_update不会自动更新auto_now字段
+            miner.update_time = now
+            update_miners.append(miner)
+        PoolMiner.objects.bulk_update(update_miners, [
+            'power', 'increase_power', 'increase_power_offset', 'total_reward', 'avg_reward', 'luck',
+            'total_block_count', 'total_win_count', 'sector_size', 'reward', 'block_count', 'ip', 'area', 'update_time'
+        ], batch_size=500)
+
+        self.get_pool_overview(must_update_cache=True, is_refresh=False)
+        data = {'miners_count': len(miners), 'update_count': len(update_miners)}
+        data.update(member_result)
+        return format_return(0, data=data)
 
     def get_pool_miners(self, sector_type=None):
         objs = PoolMiner.objects.filter(power__gt=0)
@@ -158,51 +216,52 @@ class DashboardBase(object):
     @cache_required(cache_key='dashboard_pool_trend_%s', expire=10 * 60)
     def get_pool_trend(self, days=7, must_update_cache=False):
 
-        start_date = datetime.datetime.now() - datetime.timedelta(days=days - 1)
-        start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
-
-        data = {}
-        for per in PoolMinerDay.objects.filter(date__gte=start_date).order_by('date'):
-            key = per.date.strftime('%Y-%m-%d')
-            if key not in data:
-                data[key] = {'power': 0, 'avg_rewards': [], 'increase_powers': [], 'increase_power': 0, 'total_block_count': 0, 'total_win_count': 0}
-
-            data[key]['power'] += per.power
-            data[key]['power_str'] = format_power(data[key]['power'])
-
-            data[key]['avg_rewards'].append(float(per.avg_reward))
-            data[key]['avg_reward'] = sum(data[key]['avg_rewards']) / len(data[key]['avg_rewards'])
+        # 今天之前的days-1天取每日快照的汇总
+        now = datetime.datetime.now()
+        data = self.get_pool_day_rollup(
+            dates=[(now - datetime.timedelta(days=x)).strftime('%Y-%m-%d') for x in range(days - 1, 0, -1)]
+        )
 
-            data[key]['increase_powers'].append({
-                'miner_address': per.miner_address,
-                'increase_power': float(per.increase_power)
-            })
-            data[key]['increase_power'] += float(per.increase_power)
-            data[key]['increase_power_str'] = format_power(data[key]['increase_power'])
-
-            data[key]['total_block_count'] += per.total_block_count
-            data[key]['total_win_count'] += per.total_win_count
-
-        current_data = {'power': 0, 'avg_rewards': [], 'increase_powers': [], 'increase_power': 0, 'total_block_count': 0, 'total_win_count': 0}
         # 获取当前的数据
-        for per in PoolMiner.objects.filter():
+        result = PoolMiner.objects.aggregate(**_get_pool_trend_aggregates())
+        increase_powers = [
+            {'miner_address': miner_address, 'increase_power': float(increase_power)}
+            for miner_address, increase_power in PoolMiner.objects.values_list('miner_address', 'increase_power')
+        ]
+        data[now.strftime('%Y-%m-%d')] = _get_pool_trend_data(result, increase_powers)
+        return data
 
-            current_data['power'] += per.power
-            current_data['power_str'] = format_power(current_data['power'])
+    def get_pool_day_rollup(self, dates, must_update_cache=False):
+        '''
+        按天汇总PoolMinerDay，每天的汇总单独缓存，只查询缓存中没有的日期
+        dates: 日期列表 YYYY-MM-DD，返回 {日期: 当天汇总}，没有快照的日期不返回
+        '''
+        cache_obj = cache.Cache()
+        data = {}
+        missing_dates = []
+        for date in dates:
+            data[date] = None if must_update_cache else cache_obj.get(key='dashboard_pool_day_rollup_%s' % date)
+            if data[date] is None:
+                missing_dates.append(date)
+
+        if missing_dates:
+            increase_powers = {}
+            records = PoolMinerDay.objects.filter(date__in=missing_dates).values_list('date', 'miner_address', 'increase_power')
+            for date, miner_address, increase_power in records:
+                increase_powers.setdefault(date.strftime('%Y-%m-%d'), []).append({
+                    'miner_address': miner_address, 'increase_power': float(increase_power)
+                })
 
-            current_data['avg_rewards'].append(float(per.avg_reward))
-            current_data['avg_reward'] = sum(current_data['avg_rewards']) / len(current_data['avg_rewards'])
+            rows = PoolMinerDay.objects.filter(date__in=missing_dates).values('date').annotate(**_get_pool_trend_aggregates()).order_by('date')
+            for per in rows:
+                key = per['date'].strftime('%Y-%m-%d')
+                data[key] = _get_pool_trend_data(per, increase_powers.get(key, []))
+            # 没有快照的日期也缓存，避免重复查询
+            for date in missing_dates:
+                data[date] = data[date] or {}
+                cache_obj.set(key='dashboard_pool_day_rollup_%s' % date, value=data[date], time_out=7 * 24 * 60 * 60)
 
-            current_data['increase_powers'].append({
-                'miner_address': per.miner_address,
-                'increase_power': float(per.increase_power)
-            })
-            current_data['increase_power'] += float(per.increase_power)
-            current_data['increase_power_str'] = format_power(current_data['increase_power'])
-            current_data['total_block_count'] += per.total_block_count
-            current_data['total_win_count'] += per.total_win_count
-        data[datetime.datetime.now().strftime('%Y-%m-%d')] = current_data
-        return data
+        return dict([(date, data[date]) for date in dates if data[date]])
 
     @cache_required(cache_key='dashboard_miner_ranking', expire=12 * 60 * 60)
     def get_miner_ranking(self, must_update_cache=False):
@@ -226,37 +285,71 @@ class DashboardBase(object):
 
         return data
 
-    def sync_day_pool_overview(self):
+    def sync_day_pool_overview(self, is_refresh=True):
         '''
         每天0点同步数据到这张表
+        用一条INSERT ... SELECT写入当天快照，按(date, miner_address)唯一索引覆盖，重复执行结果不变
+        is_refresh: 写入前先同步矿池矿工数据
         '''
         now = datetime.datetime.now().strftime('%Y-%m-%d') + ' 00:00:00'
-        data = self.get_pool_overview(must_update_cache=True)
-
-        for per in PoolMiner.objects.all():
-            obj, created = PoolMinerDay.objects.get_or_create(date=now, miner_address=per.miner_address)
-            obj.power = per.power
-            obj.increase_power = per.increase_power
-            obj.increase_power_offset = per.increase_power_offset
-            obj.total_reward = per.total_reward
-            obj.avg_reward = per.avg_reward
-            obj.luck = per.luck
-            obj.total_block_count = per.total_block_count
-            obj.total_win_count = per.total_win_count
-            obj.save()
-        return format_return(0)
+        if is_refresh:
+            self.sync_pool_miner_info()
+
+        sql = """
+            INSERT INTO dashboard_poolminerday
+                (date, miner_address, power, increase_power, increase_power_offset, total_reward, avg_reward,
+                 luck, total_block_count, total_win_count, create_time)
+            SELECT %s, miner_address, power, increase_power, increase_power_offset, total_reward, avg_reward,
+                luck, total_block_count, total_win_count, %s
+            FROM dashboard_poolminer
+            ON DUPLICATE KEY UPDATE
+                power = VALUES(power), increase_power = VALUES(increase_power),
+                increase_power_offset = VALUES(increase_power_offset), total_reward = VALUES(total_reward),
+                avg_reward = VALUES(avg_reward), luck = VALUES(luck), total_block_count = VALUES(total_block_count),
+                total_win_count = VALUES(total_win_count)
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [now, datetime.datetime.now()])
+            count = cursor.rowcount
+        self.get_pool_day_rollup(dates=[now[:10]], must_update_cache=True)
+        return format_return(0, data={'count': count})
 
     def sync_pool_miners(self):
-        '''同步矿池矿工'''
+        '''同步矿池矿工，按集合差一次删除、一次批量新增'''
         # data = inner_server.get_miner_list({'is_pool': 1, 'page_size': 1000})
         # for per in data['data']['objs']:
         #     obj, created = PoolMiner.objects.get_or_create(miner_address=per['miner_no'])
 
-        pool_miners = FamBase().get_pool_miners()['data']
-
-        for per in PoolMiner.objects.all():
-            if per.miner_address not in pool_miners:
-                per.delete()
-
-        for per in pool_miners:
-            obj, created = PoolMiner.objects.get_or_create(miner_address=per)
+        pool_miners = set(FamBase().get_pool_miners()['data'])
+
+        with transaction.atomic():
+            remove_count = PoolMiner.objects.exclude(miner_address__in=pool_miners).delete()[0]
+            existed_miners = set(PoolMiner.objects.values_list('miner_address', flat=True))
+            add_miners = [PoolMiner(miner_address=x) for x in pool_miners - existed_miners]
+            PoolMiner.objects.bulk_create(add_miners, ignore_conflicts=True)
+        return {'add_count': len(add_miners), 'remove_count': remove_count}
+
+
+def _get_pool_trend_aggregates():
+    return {
+        'power': Sum('power'), 'avg_reward': Avg('avg_reward'), 'increase_power': Sum('increase_power'),
+        'total_block_count': Sum('total_block_count'), 'total_win_count': Sum('total_win_count')
+    }
+
+
+def _get_pool_trend_data(result, increase_powers):
+    '''
+    矿池趋势中一天的数据
+    '''
+    power = result['power'] or 0
+    increase_power = float(result['increase_power'] or 0)
+    return {
+        'power': power,
+        'power_str': format_power(power),
+        'avg_reward': float(result['avg_reward'] or 0),
+        'increase_powers': increase_powers,
+        'increase_power': increase_power,
+        'increase_power_str': format_power(increase_power),
+        'total_block_count': result['total_block_count'] or 0,
+        'total_win_count': result['total_win_count'] or 0
+    }
@@ -5,7 +5,7 @@ class PoolMiner(models.Model):
     '''
     矿池矿工
     '''
-    miner_address = models.CharField('矿工id', max_length=128)
+    miner_address = models.CharField('矿工id', max_length=128, unique=True)
     power = models.DecimalField('有效算力', max_digits=34, decimal_places=0, default=0)
     increase_power = models.DecimalField('封装量', max_digits=34, decimal_places=0, default=0)
     increase_power_offset = models.DecimalField('新增算力', max_digits=34, decimal_places=0, default=0)
@@ -46,3 +46,19 @@ class PoolMinerDay(models.Model):
 
     class Meta:
         ordering = ["-create_time", ]
+        unique_together = [('date', 'miner_address'), ]
+
+
+class SyncLock(models.Model):
+    '''
+    后台同步锁，一个名称一行，expire_time之前被token的持有者占用
+    '''
+    name = models.CharField('锁名称', max_length=128, unique=True)
+    token = models.CharField('持有者', max_length=64, null=True)
+    expire_time = models.DateTimeField('过期时间')
+
+    create_time = models.DateTimeField('创建时间', auto_now_add=True)
+    update_time = models.DateTimeField('更新时间', auto_now=True)
+
+    class Meta:
+        ordering = ["-create_time", ]
@@ -1,9 +1,12 @@
 import json
+import datetime
 
 from django.test import TestCase
 from django.test.client import Client
 
 from explorer_s_common.utils import format_return, format_price, format_power
+from dashboard.interface import DashboardBase
+from dashboard.models import PoolMiner, PoolMinerDay
 
 
 class DashboardTestCase(TestCase):
@@ -12,6 +15,19 @@ class DashboardTestCase(TestCase):
         self.user_id = '1'
         self.client = Client(HTTP_USERID=self.user_id)
 
+    def test_sync_lock(self):
+        token = DashboardBase().acquire_lock(name='test_lock')
+        self.assertTrue(token)
+        self.assertIsNone(DashboardBase().acquire_lock(name='test_lock'))
+        # 别人的token不能释放
+        self.assertEqual(DashboardBase().release_lock(name='test_lock', token='other'), 0)
+        self.assertIsNone(DashboardBase().acquire_lock(name='test_lock'))
+        self.assertEqual(DashboardBase().release_lock(name='test_lock', token=token), 1)
+        self.assertTrue(DashboardBase().acquire_lock(name='test_lock'))
+        # 超时的锁可以重新获取
+        self.assertTrue(DashboardBase().acquire_lock(name='expired_lock', timeout=-1))
+        self.assertTrue(DashboardBase().acquire_lock(name='expired_lock'))
+
     def test_get_overview(self):
         result = self.client.post(
             '/activity/api/dashboard/get_overview', {}
@@ -41,3 +57,42 @@ class DashboardTestCase(TestCase):
             '/activity/api/dashboard/get_ranking', {}
         ).json()
         print(result)
+
+    def test_get_pool_trend(self):
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        for i, miner_address in enumerate(['f01', 'f02', 'f03']):
+            PoolMiner.objects.create(miner_address=miner_address, power=100 * i, avg_reward=i, increase_power=i)
+            for days in [1, 2]:
+                PoolMinerDay.objects.create(
+                    date=today - datetime.timedelta(days=days), miner_address=miner_address, power=10 * i,
+                    avg_reward=i + days, increase_power=days, total_block_count=1
+                )
+
+        overview = DashboardBase().get_pool_overview(must_update_cache=True, is_refresh=False)
+        self.assertEqual(overview['miners_count'], 3)
+        self.assertEqual(overview['active_miners_count'], 2)
+        self.assertEqual(overview['total_power_v'], 300)
+
+        key = (today - datetime.timedelta(days=2)).strftime('%Y-%m-%d')
+        data = DashboardBase().get_pool_day_rollup(dates=[key, (today - datetime.timedelta(days=5)).strftime('%Y-%m-%d')], must_update_cache=True)
+        self.assertEqual(list(data), [key])
+        self.assertEqual(data[key]['power'], 30)
+        self.assertEqual(data[key]['avg_reward'], 3)
+        self.assertEqual(data[key]['increase_power'], 6)
+        self.assertEqual(data[key]['total_block_count'], 3)
+        self.assertEqual(len(data[key]['increase_powers']), 3)
+
+        data = DashboardBase().get_pool_trend(2, must_update_cache=True)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[today.strftime('%Y-%m-%d')]['increase_power'], 3)
+
+    def test_sync_day_pool_overview(self):
+        PoolMiner.objects.create(miner_address='f01', power=100)
+        PoolMiner.objects.create(miner_address='f02', power=200)
+        DashboardBase().sync_day_pool_overview(is_refresh=False)
+        PoolMiner.objects.filter(miner_address='f01').update(power=150)
+        DashboardBase().sync_day_pool_overview(is_refresh=False)
+
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.assertEqual(PoolMinerDay.objects.filter(date=today).count(), 2)
+        self.assertEqual(PoolMinerDay.objects.get(date=today, miner_address='f01').power, 150)
@@ -21,6 +21,7 @@ urlpatterns = [
     url(r'^v2/get_pool_trend$', views_2.get_pool_trend),
     url(r'^v2/get_pool_mines$', views_2.get_pool_mines),
     url(r'^v2/get_pool_last_block_info$', views_2.get_pool_last_block_info),
+    url(r'^v2/sync_pool_miner_info$', views_2.sync_pool_miner_info),
     url(r'^v2/sync_day_pool_overview$', views_2.sync_day_pool_overview),
 
 ]
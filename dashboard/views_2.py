@@ -236,6 +236,14 @@ def get_pool_last_block_info(request):
     return format_return(0, data=block_miner)
 
 
+@common_ajax_response
+def sync_pool_miner_info(request):
+    '''
+    同步矿池矿工数据
+    '''
+    return DashboardBase().sync_pool_miner_info()
+
+
 @common_ajax_response
 def sync_day_pool_overview(request):
     '''
@@ -1,8 +1,13 @@
+import os
+import math
 import time
+import bisect
 import logging
+import ipaddress
 import decimal
 import requests
 import datetime
+import threading
 
 from django.db import transaction
 from django.db.models import Avg, Q, F, Sum, Count
@@ -15,6 +20,7 @@ from explorer_s_common.third.filfox_sdk import FilfoxBase
 from explorer_s_common.third.filecoin_sdk import FilecoinBase
 
 from explorer_s_activity.consts import ERROR_DICT
+from explorer_s_activity.utils import TokenBucket, fetch_concurrently
 from testnet_ranking.models import Miner, Peer, HelpRecord, RrmMiner, ActivityConfig
 
 
@@ -40,115 +46,362 @@ class IpfsunionBase(object):
         return self.fetch(url=url)
 
 
+class PeerGeoBase(object):
+    '''
+    节点区域
+    有ip的节点先用离线IP大洲表(PEER_GEO_TABLE)设置区域，再并发请求接口补全位置信息
+    location_en只保存接口返回的位置，离线表只设置area，接口没有区域时以离线表为准
+    查询失败或没有位置的节点记入失败缓存，miss_timeout秒内不再请求
+    '''
+
+    def __init__(self, table_path=None, miss_timeout=24 * 3600):
+        self.cache_key_misses = 'testnet_peer_geo_misses'
+        self.table_path = PEER_GEO_TABLE if table_path is None else table_path
+        self.miss_timeout = miss_timeout
+
+    def get_area(self, location_en):
+        '''
+        根据英文区域名称取区域标记，见Peer.area_choice
+        '''
+        if not location_en:
+            return 10
+        for continent, area in PEER_GEO_AREAS:
+            if location_en.find(continent) >= 0:
+                return area
+        return 10
+
+    def reset_areas(self):
+        '''
+        按已保存的location_en重新计算全部节点的区域标记，只更新有变化的节点
+        以前只区分亚洲，其他大洲的节点都是10，改成按大洲划分后执行一次
+        '''
+        objs = []
+        for peer_id, location_en, area in Peer.objects.filter(location_en__isnull=False).values_list('id', 'location_en', 'area'):
+            new_area = self.get_area(location_en)
+            if new_area != area:
+                objs.append(Peer(id=peer_id, area=new_area, update_time=datetime.datetime.now()))
+        Peer.objects.bulk_update(objs, ['area', 'update_time'], batch_size=1000)
+        return len(objs)
+
+    def get_table(self):
+        '''
+        加载离线IP大洲表，每个文件只加载一次
+        文件每行: 起始ip,结束ip,大洲(英文名称或AS/EU/NA/SA/OC/AF/AN)，按起始ip排序后用二分查找
+        '''
+        if not self.table_path:
+            return None
+        if self.table_path not in _peer_geo_tables:
+            with _peer_geo_lock:
+                if self.table_path not in _peer_geo_tables:
+                    ranges = []
+                    try:
+                        with open(self.table_path) as f:
+                            for line in f:
+                                items = [x.strip() for x in line.split(',')]
+                                if len(items) < 3 or not items[0] or items[0].startswith('#'):
+                                    continue
+                                try:
+                                    start, end = _ip_key(items[0]), _ip_key(items[1])
+                                except ValueError:
+                                    continue
+                                ranges.append((start, end, PEER_GEO_CONTINENT_CODES.get(items[2].upper(), items[2])))
+                    except Exception as e:
+                        debug.get_debug_detail(e)
+                    ranges.sort()
+                    _peer_geo_tables[self.table_path] = ([x[0] for x in ranges], ranges)
+        return _peer_geo_tables[self.table_path]
+
+    def get_continent(self, ip):
+        '''
+        离线查询ip所在大洲，查不到返回None
+        '''
+        table = self.get_table()
+        if not ip or not table:
+            return None
+        try:
+            key = _ip_key(ip)
+        except ValueError:
+            return None
+        starts, ranges = table
+        index = bisect.bisect_right(starts, key) - 1
+        if index >= 0 and key <= ranges[index][1]:
+            return ranges[index][2]
+        return None
+
+    def set_offline_area(self, peer):
+        '''
+        用离线表设置节点区域，只设置area，不保存，查到返回True
+        '''
+        continent = self.get_continent(peer.ip)
+        if not continent:
+            return False
+        peer.area = self.get_area(continent)
+        return True
+
+    def set_peer_info(self, peer, info):
+        '''
+        把接口返回的节点信息写到peer上，不保存
+        '''
+        peer.ip = info.get('ip') or peer.ip
+        peer.longitude = decimal.Decimal(info.get('longitude', '0') or '0')
+        peer.latitude = decimal.Decimal(info.get('latitude', '0') or '0')
+        peer.location = info.get('location')
+        peer.location_en = info.get('location_en')
+        if peer.location_en:
+            peer.area = self.get_area(peer.location_en)
+        return peer
+
+    def get_misses(self):
+        '''
+        取还在有效期内的失败节点 {peer_id: 过期时间戳}
+        '''
+        now = time.time()
+        misses = cache.Cache().get(key=self.cache_key_misses) or {}
+        return dict([(k, v) for k, v in misses.items() if v > now])
+
+    def add_misses(self, peer_ids):
+        if not peer_ids:
+            return
+        misses = self.get_misses()
+        expire = time.time() + self.miss_timeout
+        misses.update([(x, expire) for x in peer_ids])
+        cache.Cache().set(key=self.cache_key_misses, value=misses, time_out=self.miss_timeout)
+
+    def resolve_peers(self, peers, max_workers=8, rate=10):
+        '''
+        批量补全节点区域并保存，返回设置了区域的节点数
+        '''
+        misses = self.get_misses()
+        objs = {}
+        pending = []
+        for peer in peers:
+            if self.set_offline_area(peer):
+                objs[peer.peer_id] = peer
+            if peer.peer_id not in misses:
+                pending.append(peer)
+
+        results = fetch_concurrently(
+            IpfsunionBase().get_peer, [{'peer_id': x.peer_id} for x in pending],
+            max_workers=max_workers, rate_limiter=TokenBucket(rate=rate, capacity=max_workers)
+        )
+        new_misses = []
+        for peer, result in zip(pending, results):
+            info = result['data'].get('peer') if result and result.get('code') == 200 and result.get('data') else None
+            if info:
+                self.set_peer_info(peer=peer, info=info)
+                # 接口有ip没有区域时再查一次离线表
+                if not peer.location_en:
+                    self.set_offline_area(peer)
+                objs[peer.peer_id] = peer
+            if not peer.location_en:
+                new_misses.append(peer.peer_id)
+        self.add_misses(new_misses)
+
+        objs = list(objs.values())
+        now = datetime.datetime.now()
+        for peer in objs:
+            peer.update_time = now
+        Peer.objects.bulk_update(
+            objs, ['ip', 'longitude', 'latitude', 'location', 'location_en', 'area', 'update_time'], batch_size=1000
+        )
+        return len(objs)
+
+
 class RankingBase(object):
 
     def __init__(self):
         self.cache_key_reward_stat = 'test_net_reward_stat'
         self.cache_key_sp2_reward_stat = 'test_net_sp2_reward_stat'
+        self.cache_key_ranking_snapshot = 'test_net_ranking_snapshot'
+        self.cache_key_ranking_snapshot_time = 'test_net_ranking_snapshot_time'
         self.cache_timeout = 7 * 24 * 60 * 3600
 
-    def sync_data(self):
+    def sync_data(self, max_workers=8, peer_rate=10, page_workers=4, page_rate=2, chunk_size=1000):
         '''
         同步数据
+        分阶段: 流式拉取矿工 -> 每批并发补全未知节点 -> 分批写入矿工 -> 一条语句删除过期矿工 -> 计算排名
+        返回各阶段耗时(秒)
         '''
         start_time = datetime.datetime.now()
+        timings = {'fetch_miners': 0, 'sync_peers': 0, 'save_miners': 0}
+        miner_count = peer_count = resolve_count = add_count = update_count = 0
+
+        status = {}
+        miners_iter = self.sync_miners(max_workers=page_workers, rate=page_rate, status=status)
+        while True:
+            _time = time.time()
+            chunk = next(miners_iter, None)
+            timings['fetch_miners'] += time.time() - _time
+            if chunk is None:
+                break
+
+            miners = {}
+            for p in chunk:
+                if p.get('peer_id') and p.get('miner_address'):
+                    miners[p['miner_address']] = p
+            miners = list(miners.values())
+            miner_count += len(miners)
+
+            _time = time.time()
+            peer_ids, count = self.sync_peers(
+                peer_ids=set([p['peer_id'] for p in miners]), max_workers=max_workers, rate=peer_rate, chunk_size=chunk_size,
+                peer_ips=dict([(p['peer_id'], p['ip']) for p in miners if p.get('ip')])
+            )
+            peer_count += len(peer_ids)
+            resolve_count += count
+            timings['sync_peers'] += time.time() - _time
+
+            _time = time.time()
+            count = self.save_miners(miners=miners, peer_ids=peer_ids, update_time=start_time, chunk_size=chunk_size)
+            add_count += count[0]
+            update_count += count[1]
+            timings['save_miners'] += time.time() - _time
+
+        _time = time.time()
+        delete_count = 0
+        # 有页请求失败时没拉全矿工，不能当作过期记录删除
+        if miner_count and status.get('is_complete'):
+            # 清除无效矿工记录，本次写入的矿工update_time都不早于start_time
+            delete_count = Miner.objects.filter(update_time__lt=start_time).delete()[0]
+        timings['delete_miners'] = time.time() - _time
+
+        # 计算全部矿工和MINING POOL账号的排名
+        _time = time.time()
+        self.set_miner_ranking()
+        self.set_rmd_miner_ranking()
+        self.build_ranking_snapshot()
+        timings['set_ranking'] = time.time() - _time
+
+        timings['total'] = (datetime.datetime.now() - start_time).total_seconds()
+        timings = dict([(k, round(v, 3)) for k, v in timings.items()])
+        print('同步完成，耗时 %s s，各阶段耗时 %s' % (timings['total'], timings))
+        return format_return(0, data={
+            'miner_count': miner_count, 'peer_count': peer_count, 'resolve_count': resolve_count,
+            'add_count': add_count, 'update_count': update_count, 'delete_count': delete_count,
+            'is_complete': status.get('is_complete', False), 'timings': timings
+        })
+
+    def sync_peer_areas(self):
+        '''
+        重新计算已有节点的区域，并重新计算排名
+        '''
+        count = PeerGeoBase().reset_areas()
+        if count:
+            self.set_miner_ranking()
+            self.set_rmd_miner_ranking()
+            self.build_ranking_snapshot()
+        return format_return(0, data={'update_count': count})
+
+    def sync_peers(self, peer_ids, max_workers=8, rate=10, chunk_size=1000, peer_ips=None):
+        '''
+        批量同步节点
+        分批补建缺少的节点，再并发查询还没有区域的节点
+        peer_ips: 矿工数据里的节点ip {peer_id: ip}，没有ip的节点用上面的ip查离线表
+        返回 ({peer_id: 节点主键}, 设置了区域的节点数)
+        '''
+        peer_ips = peer_ips or {}
+        peer_ids = list(peer_ids)
+        peers = {}
+        for i in range(0, len(peer_ids), chunk_size):
+            chunk = peer_ids[i:i + chunk_size]
+            peers.update([(x.peer_id, x) for x in Peer.objects.filter(peer_id__in=chunk)])
+            news = [x for x in chunk if x not in peers]
+            if news:
+                Peer.objects.bulk_create([Peer(peer_id=x, ip=peer_ips.get(x)) for x in news], ignore_conflicts=True)
+                peers.update([(x.peer_id, x) for x in Peer.objects.filter(peer_id__in=news)])
+        for peer in peers.values():
+            peer.ip = peer.ip or peer_ips.get(peer.peer_id)
 
-        miners = self.sync_miners()
+        # 如果已经有了区域了则不请求
+        resolve_count = PeerGeoBase().resolve_peers(
+            peers=[x for x in peers.values() if not x.location_en], max_workers=max_workers, rate=rate
+        )
+        return dict([(k, v.id) for k, v in peers.items()]), resolve_count
 
-        count = 0
-        for p in miners:
+    def save_miners(self, miners, peer_ids, update_time, chunk_size=1000):
+        '''
+        分批写入矿工，已有的bulk_update，没有的bulk_create
+        peer_ids: {peer_id: 节点主键}
+        返回 (新增数, 更新数)
+        '''
+        fields = ['nick_name', 'peer', 'increased_power', 'increased_power_str', 'raw_byte_power', 'raw_byte_power_str', 'update_time']
+        add_count = 0
+        update_count = 0
+        for i in range(0, len(miners), chunk_size):
+            chunk = miners[i:i + chunk_size]
+            existed = dict(Miner.objects.filter(miner_address__in=[p['miner_address'] for p in chunk]).values_list('miner_address', 'id'))
+            objs = [Miner(
+                id=existed.get(p['miner_address']), miner_address=p['miner_address'], nick_name=p.get('nick_name'),
+                peer_id=peer_ids.get(p['peer_id']),
+                increased_power=p.get('increased_power') or 0, increased_power_str=p.get('increased_power_str'),
+                raw_byte_power=p.get('raw_byte_power') or 0, raw_byte_power_str=p.get('raw_byte_power_str'),
+                update_time=update_time
+            ) for p in chunk]
+            updates = [x for x in objs if x.id]
+            adds = [x for x in objs if not x.id]
             with transaction.atomic():
-
-                peer_id = p.get('peer_id')
-                if not peer_id:
-                    continue
-                # 创建节点
-                peer = self.sync_peer(peer_id=peer_id)
-
-                miner_address = p.get('miner_address')
-                if not miner_address:
-                    continue
-                count += 1
-                print('[ %s ]矿工--> %s' % (count, miner_address))
-                # 创建矿工
-                miner, created = Miner.objects.get_or_create(miner_address=miner_address)
-                miner.nick_name = p.get('nick_name')
-                miner.peer = peer
-                miner.increased_power = p.get('increased_power')
-                miner.increased_power_str = p.get('increased_power_str')
-                miner.raw_byte_power = p.get('raw_byte_power')
-                miner.raw_byte_power_str = p.get('raw_byte_power_str')
-                miner.save()
-
-                time.sleep(0.2)
-
-        if miners:
-            # 清除无效矿工记录
-            Miner.objects.filter(update_time__lt=start_time).delete()
-
-        # 计算MINING POOL账号的排名
-        self.set_rmd_miner_ranking()
-
-        end_time = datetime.datetime.now()
-        print('同步完成，耗时 %s s' % (end_time - start_time).total_seconds())
-        return format_return(0)
+                Miner.objects.bulk_update(updates, fields)
+                Miner.objects.bulk_create(adds, ignore_conflicts=True)
+            add_count += len(adds)
+            update_count += len(updates)
+        return add_count, update_count
 
     def sync_peer(self, peer_id):
         '''
         同步节点
         '''
-        # print('peer_id-->', peer_id, 'info-->', info)
         peer, created = Peer.objects.get_or_create(peer_id=peer_id)
         # 如果已经有了区域了则不请求
-        if peer.location_en:
-            return peer
-
-        result = IpfsunionBase().get_peer(peer_id=peer_id)
-        if not result or result['code'] != 200:
-            return peer
-        info = result['data']['peer']
-        peer.ip = info.get('ip')
-        peer.longitude = decimal.Decimal(info.get('longitude', '0') or '0')
-        peer.latitude = decimal.Decimal(info.get('latitude', '0') or '0')
-        peer.location = info.get('location')
-        location_en = info.get('location_en')
-        peer.location_en = location_en
-        # 是否亚洲
-        if location_en and location_en.find('Asia') >= 0:
-            peer.area = 0
-        peer.save()
+        if not peer.location_en:
+            PeerGeoBase().resolve_peers(peers=[peer])
         return peer
 
-    def sync_miners(self):
+    def sync_miners(self, page_size=100, max_pages=1000, max_workers=4, rate=2, status=None, sdk=None):
         '''
         同步矿工
+        生成器，每次并发拉取max_workers页，请求受rate(每秒请求数)限速
+        边拉取边去除无效数据，按批yield给写库阶段，某页为空或请求失败时结束
+        status: 结束时写入is_complete，拉到空页为True，请求失败或超过max_pages为False
+        sdk: 默认IpfsunionBase
         '''
+        sdk = sdk or IpfsunionBase()
+        status = {} if status is None else status
+        status['is_complete'] = False
+        rate_limiter = TokenBucket(rate=rate, capacity=max_workers)
+        total = 0
+        count = 0
         page_index = 1
-        page_size = 100
-        miners = []
-        temp = []
-
-        result = IpfsunionBase().get_miners(page_index=page_index, page_size=page_size)
-        if result and result['code'] == 200 and len(result['data']['data']) > 0:
-            temp = result['data']['data']
-
-        while temp and page_index <= 1000:
-            miners += temp
-            # print('miners--->%s, page_index-->%s' % (len(miners), page_index))
-            page_index += 1
-
-            time.sleep(1)
-            # 再次查询
-            result = IpfsunionBase().get_miners(page_index=page_index, page_size=page_size)
-            if result and result['code'] == 200:
-                temp = result['data']['data']
-            else:
-                temp = []
-
-        print('miners总数--->', len(miners))
-        miners = [x for x in miners if x['raw_byte_power'] != '0' and x['increased_power'] != '0']
-        print('去除无效数据之后的miners总数--->', len(miners))
-        return miners
+        while page_index <= max_pages:
+            params_list = [
+                {'page_index': x, 'page_size': page_size}
+                for x in range(page_index, min(page_index + max_workers, max_pages + 1))
+            ]
+            results = fetch_concurrently(sdk.get_miners, params_list, max_workers=max_workers, rate_limiter=rate_limiter)
+
+            is_end = False
+            chunk = []
+            for i, result in enumerate(results):
+                if not result or result.get('code') != 200:
+                    print('矿工第%s页请求失败，本次同步不完整' % (page_index + i))
+                    is_end = True
+                    break
+                temp = (result.get('data') or {}).get('data')
+                if not temp:
+                    status['is_complete'] = True
+                    is_end = True
+                    break
+                total += len(temp)
+                chunk += [x for x in temp if x['raw_byte_power'] != '0' and x['increased_power'] != '0']
+
+            count += len(chunk)
+            if chunk:
+                yield chunk
+            if is_end:
+                break
+            page_index += len(params_list)
+
+        print('miners总数--->', total)
+        print('去除无效数据之后的miners总数--->', count)
 
     def get_total_power(self, area=None):
         '''
@@ -210,6 +463,10 @@ class RankingBase(object):
 
     def add_rmd_miner(self, miner_address):
         obj, created = RrmMiner.objects.get_or_create(miner_address=miner_address)
+        if created:
+            # 新账号的排名和快照不用等到下次同步
+            self.set_rmd_miner_ranking()
+            self.build_ranking_snapshot()
         return format_return(0, data={'obj_id': obj.id})
 
     def get_rmd_miners(self, area=None):
@@ -220,27 +477,173 @@ class RankingBase(object):
             objs = objs.order_by('ranking')
         return objs
 
+    def set_miner_ranking(self):
+        '''
+        计算全部矿工的排名和所在区域的排名
+        按原值算力倒序、矿工地址倒序一次排序，与get_miner_ranking按个数计算的结果一致
+        '''
+        miners = list(Miner.objects.filter().values_list('id', 'raw_byte_power', 'miner_address', 'peer__area'))
+        miners.sort(key=lambda x: (x[1], x[2]), reverse=True)
+
+        objs = []
+        area_counts = {}
+        for index, (miner_id, raw_byte_power, miner_address, area) in enumerate(miners):
+            area_ranking = 0
+            if area is not None:
+                area_counts[area] = area_counts.get(area, 0) + 1
+                area_ranking = area_counts[area]
+            objs.append(Miner(id=miner_id, ranking=index + 1, area_ranking=area_ranking))
+        Miner.objects.bulk_update(objs, ['ranking', 'area_ranking'], batch_size=1000)
+        return len(objs)
+
     def set_rmd_miner_ranking(self):
         '''
-        计算MINING POOL账号排名
+        计算MINING POOL账号排名，直接取set_miner_ranking的结果
+        不在亚洲的矿工在按(原值算力, 矿工地址)排好序的亚洲矿工里二分查找名次，与get_miner_ranking的结果一致
         '''
-        for rmd_miner in RrmMiner.objects.filter():
-            rmd_miner.ranking = self.get_miner_ranking(miner_address=rmd_miner.miner_address)
-            rmd_miner.asia_ranking = self.get_miner_ranking(miner_address=rmd_miner.miner_address, area=0)
-            rmd_miner.save()
+        rmd_miners = list(RrmMiner.objects.filter())
+        miners = dict([
+            (x[0], x[1:]) for x in Miner.objects.filter(miner_address__in=[x.miner_address for x in rmd_miners])
+            .values_list('miner_address', 'ranking', 'area_ranking', 'peer__area', 'raw_byte_power')
+        ])
+        asia_keys = None
+        for rmd_miner in rmd_miners:
+            if rmd_miner.miner_address not in miners:
+                rmd_miner.ranking = rmd_miner.asia_ranking = 0
+                continue
+            ranking, area_ranking, area, raw_byte_power = miners[rmd_miner.miner_address]
+            rmd_miner.ranking = ranking
+            if area == 0:
+                rmd_miner.asia_ranking = area_ranking
+                continue
+            if asia_keys is None:
+                asia_keys = sorted(Miner.objects.filter(peer__area=0).values_list('raw_byte_power', 'miner_address'))
+            # 排在它前面的是(原值算力, 矿工地址)更大的亚洲矿工
+            rmd_miner.asia_ranking = len(asia_keys) - bisect.bisect_right(asia_keys, (raw_byte_power, rmd_miner.miner_address)) + 1
+        RrmMiner.objects.bulk_update(rmd_miners, ['ranking', 'asia_ranking'], batch_size=1000)
+
+    def build_ranking_snapshot(self):
+        '''
+        生成排名快照并缓存
+        矿工按(原值算力, 矿工地址)倒序，与set_miner_ranking的排名一致，get_ranking_page只读快照
+        '''
+        rows = list(Miner.objects.filter().values_list(*(RANKING_SNAPSHOT_FIELDS + ('peer__area', 'update_time'))))
+        rows.sort(key=lambda x: (x[0], x[1]), reverse=True)
+
+        miners = [x[:-1] for x in rows]
+        areas = {}
+        positions = {}
+        for index, per in enumerate(miners):
+            positions[per[1]] = index
+            if per[-1] is not None:
+                areas.setdefault(per[-1], []).append(index)
+        rmd_miners = [
+            (positions[x.miner_address], x.ranking, x.asia_ranking)
+            for x in self.get_rmd_miners() if x.miner_address in positions
+        ]
+
+        now = datetime.datetime.now()
+        snapshot = {
+            'miners': miners, 'areas': areas, 'rmd_miners': rmd_miners,
+            'last_update_time': max([x[-1] for x in rows]) if rows else now,
+            'create_time': now
+        }
+        # 先写快照再写快照时间，读到新时间时一定能取到新快照
+        cache_obj = cache.Cache()
+        cache_obj.set(key=self.cache_key_ranking_snapshot, value=snapshot, time_out=self.cache_timeout)
+        cache_obj.set(key=self.cache_key_ranking_snapshot_time, value=now, time_out=self.cache_timeout)
+        _ranking_snapshot['snapshot'] = snapshot
+        return snapshot
+
+    def get_ranking_snapshot(self):
+        '''
+        取排名快照
+        每次只读缓存中的快照时间，和本进程保存的快照一致时直接使用，不一致才取整个快照，缓存中没有时从数据库生成
+        '''
+        cache_obj = cache.Cache()
+        create_time = cache_obj.get(key=self.cache_key_ranking_snapshot_time)
+        snapshot = _ranking_snapshot.get('snapshot')
+        if create_time and snapshot and snapshot['create_time'] == create_time:
+            return snapshot
+
+        snapshot = cache_obj.get(key=self.cache_key_ranking_snapshot) if create_time else None
+        if not snapshot:
+            return self.build_ranking_snapshot()
+        _ranking_snapshot['snapshot'] = snapshot
+        return snapshot
+
+    def parse_cursor(self, cursor):
+        '''
+        解析get_ranking_page的游标"原值算力:矿工地址"，格式不对时抛出ValueError
+        '''
+        raw_byte_power, miner_address = cursor.split(':', 1)
+        if not miner_address:
+            raise ValueError('invalid cursor %s' % cursor)
+        return int(raw_byte_power), miner_address
+
+    def get_ranking_page(self, area=None, page_index=1, page_count=10, cursor=None):
+        '''
+        从排名快照分页取矿工排名
+        cursor: 上一页返回的next_cursor，格式为"原值算力:矿工地址"，传了则按游标翻页，忽略page_index
+        '''
+        snapshot = self.get_ranking_snapshot()
+        miners = snapshot['miners']
+        indexes = snapshot['areas'].get(int(area), []) if area is not None else range(len(miners))
+        total = len(indexes)
+        total_page = max(1, int(math.ceil(total / float(page_count))))
+
+        start = None
+        if cursor:
+            try:
+                key = self.parse_cursor(cursor)
+            except ValueError:
+                key = None
+            if key is not None:
+                # 倒序排列，找第一个小于游标的位置
+                start, end = 0, total
+                while start < end:
+                    mid = (start + end) // 2
+                    if miners[indexes[mid]][:2] < key:
+                        end = mid
+                    else:
+                        start = mid + 1
+        if start is None:
+            page_index = min(max(page_index, 1), total_page)
+            start = (page_index - 1) * page_count
+        end = min(start + page_count, total)
+
+        objs = [miners[indexes[x]] for x in range(start, end)]
+        rmd_miners = sorted(snapshot['rmd_miners'], key=lambda x: x[2] if area is not None else x[1])
+        return {
+            'miners': [dict(zip(RANKING_SNAPSHOT_FIELDS, x)) for x in objs],
+            'rmd_miners': dict([
+                (miners[index][1], dict(zip(RANKING_SNAPSHOT_FIELDS, miners[index]), ranking=ranking, asia_ranking=asia_ranking))
+                for index, ranking, asia_ranking in rmd_miners
+            ]),
+            'total_page': total_page,
+            'next_cursor': '%s:%s' % objs[-1][:2] if objs and end < total else None,
+            'last_update_time': snapshot['last_update_time'].strftime('%Y-%m-%d %H:%M:%S'),
+            'snapshot_time': snapshot['create_time'].strftime('%Y-%m-%d %H:%M:%S')
+        }
 
     def get_miner_ranking(self, miner_address, area=None):
         '''
         获取矿工排名
+        优先取set_miner_ranking算好的排名，查询其他区域的名次时才按个数计算
         '''
 
         ranking = 0
         # 获取当前矿工的原值算力
-        miner = Miner.objects.filter(miner_address=miner_address)
+        miner = Miner.objects.filter(miner_address=miner_address).select_related('peer')
         if not miner:
             return ranking
         miner = miner[0]
 
+        if area is None and miner.ranking:
+            return miner.ranking
+        if area is not None and miner.area_ranking and miner.peer and miner.peer.area == int(area):
+            return miner.area_ranking
+
         # 大于此原值算力的个数
         if area is not None:
             ranking += Miner.objects.filter(raw_byte_power__gt=miner.raw_byte_power, peer__area=area).count()
@@ -388,3 +791,32 @@ class RankingBase(object):
         cache_obj = cache.Cache()
         cache_obj.set(key=self.cache_key_sp2_reward_stat, value=data, time_out=self.cache_timeout)
         return format_return(0)
+
+
+def _ip_key(ip):
+    '''
+    ip转成可比较的(版本, 整数)，非法ip抛ValueError
+    '''
+    ip = ipaddress.ip_address(ip)
+    return ip.version, int(ip)
+
+
+# 排名快照中每个矿工保存的字段，前两个是排序键
+RANKING_SNAPSHOT_FIELDS = (
+    'raw_byte_power', 'miner_address', 'id', 'nick_name', 'increased_power', 'increased_power_str', 'raw_byte_power_str'
+)
+# 本进程保存的排名快照，见RankingBase.get_ranking_snapshot
+_ranking_snapshot = {}
+# 离线IP大洲表文件路径，见PeerGeoBase.get_table
+PEER_GEO_TABLE = os.getenv('PEER_GEO_TABLE', '')
+# 大洲英文名称对应的区域标记
+PEER_GEO_AREAS = [
+    ('Asia', 0), ('Europe', 1), ('North America', 2), ('South America', 3), ('Oceania', 4), ('Africa', 5), ('Antarctica', 6)
+]
+# 大洲代码对应的英文名称
+PEER_GEO_CONTINENT_CODES = {
+    'AS': 'Asia', 'EU': 'Europe', 'NA': 'North America', 'SA': 'South America', 'OC': 'Oceania', 'AF': 'Africa', 'AN': 'Antarctica'
+}
+# 已加载的离线IP大洲表 {文件路径: (起始ip列表, [(起始ip, 结束ip, 大洲)])}
+_peer_geo_tables = {}
+_peer_geo_lock = threading.Lock()
@@ -7,7 +7,7 @@ class Peer(models.Model):
     '''
     area_choice = ((0, '亚洲'), (1, '欧洲'), (2, '北美洲'), (3, '南美洲'), (4, '大洋洲'), (5, '非洲'), (6, '南极洲'), (10, '其他'))
 
-    peer_id = models.CharField('peer_id', max_length=192)
+    peer_id = models.CharField('peer_id', max_length=192, unique=True)
     ip = models.CharField('ip', max_length=192, null=True)
     longitude = models.DecimalField('经度', max_digits=10, decimal_places=6, default=0)
     latitude = models.DecimalField('纬度', max_digits=10, decimal_places=6, default=0)
@@ -26,13 +26,15 @@ class Miner(models.Model):
     '''
     矿工表
     '''
-    miner_address = models.CharField('矿工地址', max_length=128)
+    miner_address = models.CharField('矿工地址', max_length=128, unique=True)
     nick_name = models.CharField('矿工昵称', max_length=128, null=True)
     peer = models.ForeignKey('Peer', on_delete=models.DO_NOTHING, null=True)
     increased_power = models.BigIntegerField('有效算力', default=0)
     increased_power_str = models.CharField('有效算力展示', max_length=64, null=True)
-    raw_byte_power = models.BigIntegerField('原值算力', default=0)
+    raw_byte_power = models.BigIntegerField('原值算力', default=0, db_index=True)
     raw_byte_power_str = models.CharField('原值算力展示', max_length=64, null=True)
+    ranking = models.IntegerField('排名', default=0)
+    area_ranking = models.IntegerField('所在区域排名', default=0)
 
     create_time = models.DateTimeField('创建时间', auto_now_add=True)
     update_time = models.DateTimeField('修改时间', auto_now=True)
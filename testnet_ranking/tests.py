@@ -1,12 +1,30 @@
+import os
 import json
+import datetime
+import tempfile
 
 from django.test import TestCase
 from django.test.client import Client
 
-from testnet_ranking.interface import RankingBase
+from testnet_ranking.interface import RankingBase, PeerGeoBase
 from testnet_ranking.models import Peer, Miner
 
 
+class FakeIpfsunion(object):
+    '''
+    按页返回矿工，failed_pages中的页请求失败
+    '''
+
+    def __init__(self, miners, failed_pages=()):
+        self.miners = miners
+        self.failed_pages = failed_pages
+
+    def get_miners(self, page_index=1, page_size=100):
+        if page_index in self.failed_pages:
+            return {}
+        return {'code': 200, 'data': {'data': self.miners[(page_index - 1) * page_size:page_index * page_size]}}
+
+
 class RankingTestCase(TestCase):
 
     def setUp(self):
@@ -37,6 +55,132 @@ class RankingTestCase(TestCase):
     def test_sync_data(self):
         RankingBase().sync_data()
 
+    def test_save_miners(self):
+        peer_ids = dict(Peer.objects.values_list('peer_id', 'id'))
+        update_time = datetime.datetime.now()
+        add_count, update_count = RankingBase().save_miners(miners=[
+            {'miner_address': 't001', 'peer_id': '2', 'increased_power': '3000', 'raw_byte_power': '3000'},
+            {'miner_address': 't009', 'peer_id': '1', 'increased_power': '900', 'raw_byte_power': '900'},
+        ], peer_ids=peer_ids, update_time=update_time, chunk_size=1)
+        self.assertEqual((add_count, update_count), (1, 1))
+
+        miner = Miner.objects.get(miner_address='t001')
+        self.assertEqual((miner.raw_byte_power, miner.peer.peer_id), (3000, '2'))
+        self.assertEqual(Miner.objects.get(miner_address='t009').raw_byte_power, 900)
+        # 未写入的矿工会被sync_data当作过期记录删除
+        self.assertEqual(Miner.objects.filter(update_time__lt=update_time).count(), 4)
+
+    def test_sync_miners(self):
+        miners = [{'miner_address': 't%03d' % i, 'raw_byte_power': '1', 'increased_power': '1'} for i in range(5)]
+
+        # 拉到空页才算拉全
+        status = {}
+        chunks = list(RankingBase().sync_miners(page_size=2, max_workers=2, rate=100, status=status, sdk=FakeIpfsunion(miners)))
+        self.assertEqual(sum([len(x) for x in chunks]), 5)
+        self.assertTrue(status['is_complete'])
+
+        # 请求失败时结束但不算拉全，sync_data不会删除没拉到的矿工
+        status = {}
+        chunks = list(RankingBase().sync_miners(page_size=2, max_workers=2, rate=100, status=status, sdk=FakeIpfsunion(miners, failed_pages=[2])))
+        self.assertEqual(sum([len(x) for x in chunks]), 2)
+        self.assertFalse(status['is_complete'])
+
+    def test_peer_geo(self):
+        self.assertEqual(PeerGeoBase().get_area('Shanghai, China, Asia'), 0)
+        self.assertEqual(PeerGeoBase().get_area('California, United States, North America'), 2)
+        self.assertEqual(PeerGeoBase().get_area(None), 10)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('# 起始ip,结束ip,大洲\n127.0.0.0,127.0.0.3,EU\n127.0.0.4,127.0.0.255,Asia\n')
+        try:
+            geo = PeerGeoBase(table_path=f.name)
+            self.assertEqual(geo.get_continent('127.0.0.2'), 'Europe')
+            self.assertEqual(geo.get_continent('127.0.0.5'), 'Asia')
+            self.assertIsNone(geo.get_continent('10.0.0.1'))
+            self.assertIsNone(geo.get_continent('unknown'))
+
+            # 离线表只设置区域，location_en留给接口返回的位置
+            geo.add_misses(['1', '5'])
+            peers = list(Peer.objects.filter(peer_id__in=['1', '5']).order_by('peer_id'))
+            self.assertEqual(geo.resolve_peers(peers=peers), 2)
+            self.assertEqual([(x.location_en, x.area) for x in Peer.objects.filter(peer_id__in=['1', '5']).order_by('peer_id')], [(None, 1), (None, 0)])
+
+            # 新节点保存矿工数据里的ip，用来查离线表
+            geo.add_misses(['7'])
+            RankingBase().sync_peers(peer_ids=['7'], peer_ips={'7': '127.0.0.7'})
+            self.assertEqual(geo.resolve_peers(peers=[Peer.objects.get(peer_id='7')]), 1)
+            self.assertEqual((Peer.objects.get(peer_id='7').ip, Peer.objects.get(peer_id='7').area), ('127.0.0.7', 0))
+        finally:
+            os.remove(f.name)
+
+        # 以前只区分亚洲，已有的其他大洲节点按location_en重新计算
+        Peer.objects.filter(peer_id='2').update(location_en='Paris, France, Europe', area=10)
+        Peer.objects.filter(peer_id='3').update(location_en='Tokyo, Japan, Asia', area=0)
+        result = self.client.post('/activity/api/testnet_ranking/sync_peer_areas', {}).json()
+        self.assertEqual(result['data']['update_count'], 1)
+        self.assertEqual(Peer.objects.get(peer_id='2').area, 1)
+        self.assertEqual(Miner.objects.get(miner_address='t002').area_ranking, 1)
+
+        geo = PeerGeoBase(table_path='')
+        geo.add_misses(['1'])
+        self.assertIn('1', geo.get_misses())
+
+    def test_set_miner_ranking(self):
+        peer = Peer.objects.create(peer_id='6', ip='127.0.0.6', area=1)
+        Miner.objects.create(miner_address='t006', peer=peer, raw_byte_power=2000)
+        Miner.objects.create(miner_address='t000', peer=None, raw_byte_power=1100)
+        RankingBase().set_miner_ranking()
+        RankingBase().set_rmd_miner_ranking()
+
+        # 同算力按矿工地址倒序
+        self.assertEqual([x.miner_address for x in Miner.objects.order_by('ranking')], ['t006', 't005', 't004', 't003', 't002', 't000', 't001'])
+        self.assertEqual(Miner.objects.get(miner_address='t002').area_ranking, 4)
+        self.assertEqual(Miner.objects.get(miner_address='t006').area_ranking, 1)
+        self.assertEqual(RankingBase().get_miner_ranking(miner_address='t006', area=0), 1)
+        self.assertEqual(RankingBase().get_miner_ranking(miner_address='t001'), 7)
+        rmd_miner = RankingBase().get_rmd_miners()[0]
+        self.assertEqual((rmd_miner.ranking, rmd_miner.asia_ranking), (5, 4))
+
+        # 不在亚洲的矿工按亚洲矿工计算名次
+        Peer.objects.filter(peer_id='4').update(area=1)
+        RankingBase().set_miner_ranking()
+        RankingBase().add_rmd_miner(miner_address='t004')
+        RankingBase().set_rmd_miner_ranking()
+        rmd_miners = dict([(x.miner_address, x.asia_ranking) for x in RankingBase().get_rmd_miners()])
+        self.assertEqual(rmd_miners['t004'], 2)
+        self.assertEqual(rmd_miners['t004'], RankingBase().get_miner_ranking(miner_address='t004', area=0))
+
+    def test_get_ranking_page(self):
+        RankingBase().set_miner_ranking()
+        RankingBase().set_rmd_miner_ranking()
+        RankingBase().build_ranking_snapshot()
+
+        data = RankingBase().get_ranking_page(page_count=2)
+        self.assertEqual([x['miner_address'] for x in data['miners']], ['t005', 't004'])
+        self.assertEqual((data['total_page'], data['next_cursor']), (3, '1300:t004'))
+        self.assertEqual(data['rmd_miners']['t002']['ranking'], 4)
+
+        # 游标翻页和按页码翻页结果一致
+        data = RankingBase().get_ranking_page(page_count=2, cursor=data['next_cursor'])
+        self.assertEqual(data['miners'], RankingBase().get_ranking_page(page_count=2, page_index=2)['miners'])
+        data = RankingBase().get_ranking_page(area=0, page_count=2, cursor=data['next_cursor'])
+        self.assertEqual([x['miner_address'] for x in data['miners']], ['t001'])
+        self.assertIsNone(data['next_cursor'])
+
+        # 同步之后新加的MINING POOL账号马上出现在快照里
+        RankingBase().add_rmd_miner(miner_address='t004')
+        data = RankingBase().get_ranking_page(page_count=2)
+        self.assertEqual(list(data['rmd_miners']), ['t004', 't002'])
+        self.assertEqual(data['rmd_miners']['t004']['ranking'], 2)
+
+        # 不合法的区域、游标和分页参数返回错误码
+        for params, code in [
+            ({'area': ''}, 0), ({'area': 'asia'}, 14005), ({'area': '9'}, 14005), ({'cursor': '1300'}, 14006),
+            ({'cursor': 'abc:t004'}, 14006), ({'page_count': '0'}, 14007), ({'page_index': 'x'}, 14007)
+        ]:
+            result = self.client.post('/activity/api/testnet_ranking/get_ranking', params).json()
+            self.assertEqual(result['code'], code)
+
     def test_get_ranking(self):
         result = self.client.post(
             '/activity/api/testnet_ranking/get_ranking', {}
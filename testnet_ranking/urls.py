@@ -15,6 +15,7 @@ urlpatterns = [
     url(r'^add_help_record$', views.add_help_record),
 
     url(r'^sync_data$', views.sync_data),
+    url(r'^sync_peer_areas$', views.sync_peer_areas),
     url(r'^sync_block_ranking$', views.sync_block_ranking),
     url(r'^sync_reward_stat$', views.sync_reward_stat),
     url(r'^sync_sp2_reward_stat$', views.sync_sp2_reward_stat),
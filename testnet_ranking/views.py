@@ -14,6 +14,7 @@ from explorer_s_common.third.filscout_sdk import FilscoutBase
 
 from explorer_s_activity import consts
 from testnet_ranking.interface import RankingBase
+from testnet_ranking.models import Peer
 
 
 @common_ajax_response
@@ -22,45 +23,33 @@ def get_ranking(request):
     获取排名
     '''
     area = request.POST.get('area')
-    page_count = min(int(request.POST.get('page_count', 10)), 100)
-    page_index = int(request.POST.get('page_index', 1))
-
-    # 矿工
-    rmd_miners = {}
-    for p in RankingBase().get_rmd_miners(area=area):
-        miner = RankingBase().get_miner_by_address(address=p.miner_address)
-        if not miner:
-            continue
-        rmd_miners[p.miner_address] = {
-            'miner_address': p.miner_address,
-            'ranking': p.ranking,
-            'asia_ranking': p.asia_ranking,
-            'nick_name': miner.nick_name,
-            'increased_power': miner.increased_power,
-            'increased_power_str': miner.increased_power_str,
-            'raw_byte_power': miner.raw_byte_power,
-            'raw_byte_power_str': miner.raw_byte_power_str
-        }
-
-    # 矿工
-    miners = []
-    objs = RankingBase().get_miners(area=area)
-    data = Page(objs, page_count).page(page_index)
-    for p in data['objects']:
-        miners.append({
-            'id': p.id, 'miner_address': p.miner_address, 'nick_name': p.nick_name,
-            'increased_power': p.increased_power, 'increased_power_str': p.increased_power_str,
-            'raw_byte_power': p.raw_byte_power, 'raw_byte_power_str': p.raw_byte_power_str
-        })
-
-    # 获取最后更新时间
-    last_update_time = RankingBase().get_last_update_time()
-
-    return format_return(0, data={
-        'miners': miners, 'rmd_miners': rmd_miners,
-        'total_page': data['total_page'],
-        'last_update_time': last_update_time.strftime('%Y-%m-%d %H:%M:%S')
-    })
+    cursor = request.POST.get('cursor')
+    try:
+        page_count = min(int(request.POST.get('page_count', 10)), 100)
+        page_index = int(request.POST.get('page_index', 1))
+    except ValueError:
+        return format_return(14007)
+    if page_count < 1:
+        return format_return(14007)
+
+    # 不传或传空表示全部区域
+    if area in (None, ''):
+        area = None
+    else:
+        try:
+            area = int(area)
+        except ValueError:
+            return format_return(14005)
+        if area not in dict(Peer.area_choice):
+            return format_return(14005)
+    if cursor:
+        try:
+            RankingBase().parse_cursor(cursor)
+        except ValueError:
+            return format_return(14006)
+
+    data = RankingBase().get_ranking_page(area=area, page_index=page_index, page_count=page_count, cursor=cursor)
+    return format_return(0, data=data)
 
 
 @common_ajax_response
@@ -186,6 +175,14 @@ def sync_data(request):
     return RankingBase().sync_data()
 
 
+@common_ajax_response
+def sync_peer_areas(request):
+    '''
+    按已保存的区域名称重新计算节点区域
+    '''
+    return RankingBase().sync_peer_areas()
+
+
 @common_ajax_response
 def sync_block_ranking(request):
     return RankingBase().sync_block_ranking()
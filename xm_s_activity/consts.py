@@ -2,4 +2,11 @@ from explorer_s_common.consts import ERROR_DICT
 
 ERROR_DICT.update({
     14000: '添加失败，订单号重复',
+    14001: '参数错误，scenarios必须是合法的场景列表',
+    14002: '场景数量不能超过50个',
+    14003: '数据输出失败',
+    14004: '获取区块分页失败',
+    14005: '参数错误，area不合法',
+    14006: '参数错误，cursor不合法',
+    14007: '参数错误，分页参数不合法',
 })
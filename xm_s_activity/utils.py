@@ -0,0 +1,272 @@
+import time
+import array
+import decimal
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from explorer_s_common import debug
+
+
+class TokenBucket(object):
+    '''
+    令牌桶限速
+    rate: 每秒产生的令牌数
+    capacity: 桶容量，即允许的突发请求数
+    '''
+
+    def __init__(self, rate=1, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        获取令牌，不够则等待
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_concurrently(func, params_list, max_workers=4, rate_limiter=None):
+    '''
+    用有界线程池并发调用func(**params)，结果按params_list的顺序返回，异常的结果为None
+    '''
+
+    def _fetch(params):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            return func(**params)
+        except Exception as e:
+            debug.get_debug_detail(e)
+            return None
+
+    if not params_list:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(params_list)))) as executor:
+        return list(executor.map(_fetch, params_list))
+
+
+class ColumnarRows(object):
+    '''
+    按列存储的一组行，缓存时只序列化表头和每列的字节
+    schema: [(字段名, 类型)]，类型 decimal 存Decimal的字符串(精确)、int 存int64、date 存日期序数
+    按下标、切片、迭代取到的是ColumnarRow，取值时才转换成Decimal/date
+    '''
+    typecodes = {'int': 'q', 'date': 'q'}
+
+    def __init__(self, schema, columns=None):
+        self.schema = [tuple(x) for x in schema]
+        self.kinds = dict(self.schema)
+        self.columns = columns or dict([
+            (name, [] if kind == 'decimal' else array.array(self.typecodes[kind])) for name, kind in self.schema
+        ])
+
+    @classmethod
+    def from_rows(cls, rows, schema):
+        '''
+        从dict(或ColumnarRow)列表生成，缺少的字段记为0
+        '''
+        obj = cls(schema)
+        for name, kind in obj.schema:
+            if kind == 'date':
+                obj.columns[name].extend([per[name].toordinal() for per in rows])
+            elif kind == 'int':
+                obj.columns[name].extend([int(per.get(name, 0)) for per in rows])
+            else:
+                obj.columns[name].extend([str(per.get(name, 0)) for per in rows])
+        return obj
+
+    def get_value(self, name, index):
+        value = self.columns[name][index]
+        kind = self.kinds[name]
+        if kind == 'date':
+            return datetime.date.fromordinal(value)
+        if kind == 'decimal':
+            return decimal.Decimal(value)
+        return value
+
+    def column(self, name):
+        '''
+        取整列，已转换类型
+        '''
+        kind = self.kinds[name]
+        if kind == 'date':
+            return [datetime.date.fromordinal(x) for x in self.columns[name]]
+        if kind == 'decimal':
+            return [decimal.Decimal(x) for x in self.columns[name]]
+        return self.columns[name].tolist()
+
+    def to_rows(self):
+        return [per.to_dict() for per in self]
+
+    def __len__(self):
+        return len(self.columns[self.schema[0][0]]) if self.schema else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ColumnarRows(self.schema, dict([(name, column[index]) for name, column in self.columns.items()]))
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('ColumnarRows index out of range')
+        return ColumnarRow(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield ColumnarRow(self, index)
+
+    def __add__(self, other):
+        if isinstance(other, ColumnarRows) and other.schema == self.schema:
+            return ColumnarRows(self.schema, dict([(name, column + other.columns[name]) for name, column in self.columns.items()]))
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __getstate__(self):
+        return {'schema': self.schema, 'columns': dict([
+            (name, ' '.join(column) if self.kinds[name] == 'decimal' else column.tobytes())
+            for name, column in self.columns.items()
+        ])}
+
+    def __setstate__(self, state):
+        self.__init__(state['schema'])
+        for name, data in state['columns'].items():
+            if self.kinds[name] == 'decimal':
+                self.columns[name] = data.split(' ') if data else []
+            else:
+                self.columns[name].frombytes(data)
+
+
+class ColumnarRow(object):
+    '''
+    ColumnarRows中的一行，用法同dict，取过的值和修改的值只保存在本行
+    '''
+    __slots__ = ('rows', 'index', 'values')
+
+    def __init__(self, rows, index):
+        self.rows = rows
+        self.index = index
+        self.values = {}
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            if key not in self.rows.kinds:
+                raise KeyError(key)
+            self.values[key] = self.rows.get_value(key, self.index)
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __contains__(self, key):
+        return key in self.values or key in self.rows.kinds
+
+    def __eq__(self, other):
+        if isinstance(other, (ColumnarRow, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [name for name, kind in self.rows.schema] + [x for x in self.values if x not in self.rows.kinds]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+class RowFormatter(object):
+    '''
+    按声明的字段格式批量格式化行数据
+    fields: [(输出字段, 来源字段, 格式化函数)]，格式化函数为None时原样输出
+    按列格式化，同一列中重复的值只格式化一次
+    '''
+
+    def __init__(self, fields):
+        self.fields = [tuple(x) for x in fields]
+
+    @staticmethod
+    def memo_key(value):
+        '''
+        格式化缓存的键，相等但格式化结果可能不同的值(1、1.0、Decimal('1.00')、-0.0)不共用
+        '''
+        if isinstance(value, decimal.Decimal):
+            return (decimal.Decimal, value.as_tuple())
+        if isinstance(value, float):
+            return (float, value.hex())
+        return (type(value), value)
+
+    def format_column(self, values, func):
+        if func is None:
+            return list(values)
+        memo = {}
+        result = []
+        for value in values:
+            try:
+                key = self.memo_key(value)
+                if key not in memo:
+                    memo[key] = func(value)
+                result.append(memo[key])
+            except TypeError:
+                result.append(func(value))
+        return result
+
+    def apply(self, rows):
+        '''
+        在行上原地格式化，返回rows
+        '''
+        for key, source, func in self.fields:
+            values = self.format_column([per[source] for per in rows], func)
+            for per, value in zip(rows, values):
+                per[key] = value
+        return rows
+
+    def iter_json(self, rows, keys=None, chunk_size=100, is_format=False, encoder=None):
+        '''
+        把行编码成JSON数组，按chunk_size行一段输出
+        rows: 行的列表、ColumnarRows或生成器，按段取出，不会整体复制
+        keys: 只输出这些字段，不传则输出整行
+        is_format: 每段输出前再格式化，此时rows可以是尚未格式化的行或ColumnarRows
+        encoder: 共用的JSONEncoder，不传则用DjangoJSONEncoder
+        '''
+        encoder = encoder or DjangoJSONEncoder()
+
+        def _encode(chunk, is_first):
+            if is_format:
+                chunk = self.apply([per.to_dict() if isinstance(per, ColumnarRow) else per for per in chunk])
+            if keys is not None:
+                chunk = [dict([(key, per[key]) for key in keys if key in per]) for per in chunk]
+            return ('' if is_first else ',') + ','.join([encoder.encode(per) for per in chunk])
+
+        yield '['
+        chunk = []
+        is_first = True
+        for per in rows:
+            chunk.append(per)
+            if len(chunk) >= chunk_size:
+                yield _encode(chunk, is_first)
+                chunk = []
+                is_first = False
+        if chunk:
+            yield _encode(chunk, is_first)
+        yield ']'